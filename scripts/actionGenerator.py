@@ -1,25 +1,31 @@
 #! /usr/bin/env python3
 
 import argparse
-from functools import reduce
+import buildcache
+import comlinks
+import distancemap
 import itertools
 import json
 import logging
 import math
+import multiprocessing
+import numpy as np
 import os
 from pprint import pprint
 import shutil
+import socketserver
 import sys
+import threading
 import yaml
 
+import incremental
+import missionmodel
+import motiongraph
 import pddl
+import querycache
+import reduction
 import subprocess
-
-try:
-    import gladys
-except ImportError:
-    print("[error] install gladys [and setup PYTHONPATH]")
-    sys.exit(1)
+import terrain
 
 
 
@@ -38,6 +44,22 @@ initActionLength = 30 #s
 useAAVPatrol = True
 useAGVPatrol = True
 
+#ids of the bits set in mask, in increasing order
+def bitsOf(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+#Duration of a motion of an AAV over dist (scalar or array) : trapezoidal speed profile with
+#acceleration accAAV and maximum speed speedAAV, plus a constant delay. A null distance costs nothing
+def aavMotionDuration(dist):
+    dist = np.asarray(dist, dtype=float)
+    cruise = dist/speedAAV + speedAAV/accAAV   #reaches speedAAV
+    short = 2 * np.sqrt(dist/accAAV)            #accelerates on the first half, decelerates on the second one
+    duration = np.where(dist >= speedAAV*speedAAV/accAAV, cruise, short)
+    return np.where(dist == 0, 0., duration + motionDelayAAV)
+
 class IllFormatedInput(Exception):
     pass
 
@@ -48,46 +70,36 @@ costExploreAction = 1
 
 class ProblemGenerator:
     
-    def __init__(self, mission, distanceFile):
+    def __init__(self, mission, distanceFile, queryCacheFile = None, jobs = 1, terrainPool = None, terrainBackend = terrain.defaultBackend, viewshedFolder = None):
     
         self.canLaunchHiPOP = True
-        self.mission = mission
-            
-        ##Convert all data to numeric format
-        for agent in self.mission["agents"].keys():
-            if "spare" in self.mission["agents"][agent]:
-                if self.mission["agents"][agent]["spare"] in ["false", "False"]:
-                    self.mission["agents"][agent]["spare"] = False
-                elif self.mission["agents"][agent]["spare"] in ["true", "True"]:
-                    self.mission["agents"][agent]["spare"] = True
-                else:
-                    logging.error("Cannot convert %s to boolean" % self.mission["agents"][agent]["spare"])
-                    sys.exit(1)
-            else:
-                self.mission["agents"][agent]["spare"] = False
-
-            for k,v in self.mission["agents"][agent]["position"].items():
-                self.mission["agents"][agent]["position"][k] = float(v)
-                
-        for wpg in self.mission["wp_groups"].keys():
-            for wpn in self.mission["wp_groups"][wpg]["waypoints"].keys():
-                for k,v in self.mission["wp_groups"][wpg]["waypoints"][wpn].items():
-                    self.mission["wp_groups"][wpg]["waypoints"][wpn][k] = float(v)
-
-        for obs in self.mission["mission_goal"]["observation_points"].keys():
-            for k,v in self.mission["mission_goal"]["observation_points"][obs].items():
-                self.mission["mission_goal"]["observation_points"][obs][k] = float(v)
-        if self.mission["mission_goal"]["communication_goals"] == "":
-            self.mission["mission_goal"]["communication_goals"] = {} #Boost::property_tree replace {} with ""
-
-        ##
+        self.jobs = jobs
+        self.terrainPool = terrainPool if terrainPool is not None else terrain.TerrainPool() #models with the same terrain files share it
+        self.terrainBackend = terrainBackend
+        self.viewshedFolder = viewshedFolder
+        #identifies the way the terrain queries are answered, in the caches
+        self.terrainTag = terrainBackend if viewshedFolder is None else terrainBackend + "-viewsheds"
+        self.useAAVPatrol = useAAVPatrol
+        self.useAGVPatrol = useAGVPatrol
+        #drop the waypoints and observation points that cannot contribute to the goals before writing the problem
+        self.reduceProblem = False
+        self.reduction = None
+        #write only the motions that are not dominated by a path through another waypoint, and only to
+        #the motionNeighbours nearest waypoints if it is not None
+        self.sparseMotion = False
+        self.motionNeighbours = None
+        self.mission = mission #normalized by missionmodel.compileMission
     
         homeDir = str(self.mission["home_dir"])
         if not os.path.exists(homeDir):
             logging.error("Home folder defined in the mission file do not exists : %s" % homeDir)
             sys.exit(1)
 
-        self.gladys = {}
+        self.queryCache = querycache.QueryCache(queryCacheFile)
+
+        self.gladys = {} #loaded on demand by getTerrain
+        self.terrainFiles = {} #key:model. Value : (regionFile, dtmFile, configFile)
+        self.queryContexts = {}
         for name,model in self.mission["models"].items():
             
             regionFile = os.path.join(homeDir, str(self.mission["map_data"]["region_file"]))
@@ -103,205 +115,297 @@ class ProblemGenerator:
                 sys.exit(1)
             
             configFile = os.path.join(homeDir, str(model["config_file"]))
-            if not os.path.exists(configFile):
-                logging.error("Cannot open %s" % configFile)
-                sys.exit(1)
-
-            self.gladys[name] = gladys.gladys(regionFile, dtmFile, configFile)
-        
-            with open(os.path.join(homeDir, model["config_file"])) as f:
-                modelData = json.load(f)
 
-            for k,v in modelData.items():
-                model[k] = v
+            self.terrainFiles[name] = (regionFile, dtmFile, configFile)
+            self.queryContexts[name] = self.queryCache.getContext(dtmFile, regionFile, configFile, tag=self.terrainTag)
 
-            logging.info("Velocity of %s : %f" % (name,modelData["robot"]["velocity"]))
+            logging.info("Velocity of %s : %f" % (name,model["robot"]["velocity"]))
     
-        self.initIndex = {}
-        for agent in self.getRobotList():
-            initPos = self.mission["agents"][agent]["position"]
-            initIndex = None
-            for index,pt in self.mission["wp_groups"][self.mission["agents"][agent]["wp_group"]]["waypoints"].items():
-                if(pt["x"] == initPos["x"] and pt["y"] == initPos["y"]):
-                    initIndex = index
-                    break
-                    
-            if initIndex is None:
-                initIndex = "_init_" + agent
-                self.mission["wp_groups"][self.mission["agents"][agent]["wp_group"]]["waypoints"][initIndex] = initPos
-            
-            self.initIndex[agent] = initIndex
+        #agents, models, waypoints and observation points used by the generation
+        self.missionModel = missionmodel.Mission(self.mission)
         
-        self.distanceMap = {}
-
-        self.computeDistanceAGV(distanceFile)
+        #the distances are computed on demand by getDistanceMap
+        self.distanceFile = distanceFile
+        self.distanceMap = None
+
+        #key:(model, wp_group). Value : boolean matrix waypoint id x observation point id
+        self.visibility = {}
+        #key:(model, wp_group). Value : for each waypoint id, bitmask of the visible observation point ids
+        self.coverage = {}
+        #key:(model, wp_group, index, observation point). Value : visibility known from a previous run
+        self.visibilitySeed = {}
+
+        #key:sorted pair of (model, wp_group, index). Value : True if they can communicate
+        self.comLinks = {}
         
         logging.info("Initialisation done")
 
 
-    def computeDistanceAGV(self, distanceFile):
-
-        recompute = False
-        if os.access(distanceFile, os.R_OK):
-            with open(distanceFile, "r") as f:
-                self.distanceMap = json.load(f)
-
-            #Check if it needs to be recomputed
-            for model in self.mission["models"].keys():
-                if not self.useGladysForModel(model): continue
-                if model not in self.distanceMap :
-                    recompute = True
-                    break
-
-                points = set()
-                for r in self.mission["agents"].values():
-                    if r["model"] == model:
-                        for pt in self.mission["wp_groups"][r["wp_group"]]["waypoints"].values():
-                            points.add((pt["x"], pt["y"]))
-                points = list(points)
-
-                for pt1,pt2 in itertools.combinations(points, 2):
-                    k1 = "%s_%s_%s_%s" % (pt1[0], pt1[1], pt2[0], pt2[1])
-                    k2 = "%s_%s_%s_%s" % (pt2[0], pt2[1], pt1[0], pt1[1])
-                    if k1 not in self.distanceMap[model] and k2 not in self.distanceMap[model]:
-                        logging.warning("Points have changed. Recomputing the distances")
-                        recompute = True
-                        break
-
-                if recompute:
-                    break
-
-        else:
-            logging.warning("Cannot find %s. Using gladys to compute the distances." % distanceFile)
-            recompute = True
+    def getTerrain(self, model):
+        if model not in self.gladys:
+            regionFile, dtmFile, configFile = self.terrainFiles[model]
+            antennaHeight = self.missionModel.models[model].antennaHeight
+            g = self.terrainPool.get(regionFile, dtmFile, configFile, self.terrainBackend)
+            if self.viewshedFolder is not None:
+                g = terrain.ViewshedTerrain(g, self.viewshedFolder, dtmFile)
+            self.gladys[model] = querycache.CachedTerrain(g, self.queryCache, self.queryContexts[model], antennaHeight)
+        return self.gladys[model]
 
-        if recompute:
-            for model in self.mission["models"].keys():
-                if not self.useGladysForModel(model):
-                    continue
-                
-                logging.info("Pre-computing distances for %s" % model)
+    def getDistanceMap(self):
+        if self.distanceMap is None:
+            self.computeDistanceAGV(self.distanceFile)
+        return self.distanceMap
 
-                self.distanceMap[model] = {}
-                
-                g = self.gladys[model]
-                
-                points = set()
-                for r in self.mission["agents"].values():
-                    if r["model"] == model:
-                        for pt in self.mission["wp_groups"][r["wp_group"]]["waypoints"].values():
-                            points.add((pt["x"], pt["y"]))
-                points = list(points)
-
-                for i in range(len(points)):
-                    logging.debug("Using gladys for computing distance map of %s %d / %d" % (model,i,len(points)))
-                    costs = g.single_source_all_costs(points[i], points[i+1:])
-                    for j,cost in zip(range(i+1, len(points)), costs):
-                        #print("%.2f,%.2f -> %.2f,%.2f : %.2f" % (points[i][0], points[i][1], points[j][0], points[j][1], cost))
-                        self.distanceMap[model]["%s_%s_%s_%s" % (points[i][0], points[i][1], points[j][0], points[j][1])] = cost
-
-                logging.info("Computing distances for %s done" % model)
-        
-            with open(distanceFile, "w") as f:
-                json.dump(self.distanceMap, f)
+    #distanceFile is the folder of the binary distance store. A json distance map with the same name
+    #and a .json extension is imported if it exists.
+    def computeDistanceAGV(self, distanceFile):
 
+        self.distanceMap = distancemap.DistanceStore(distanceFile, distanceFile + ".json")
+
+        for model in self.getModelList():
+            if not self.useGladysForModel(model):
+                continue
+
+            points = set()
+            for agent in self.missionModel.agents.values():
+                if agent.model == model:
+                    group = self.missionModel.groups[agent.group]
+                    points.update(zip(group.x.tolist(), group.y.tolist()))
+
+            self.distanceMap.update(model, sorted(points), lambda rows: self.computeDistanceRows(model, rows))
+
+        self.distanceMap.save()
+
+    #rows is a list of (i, source, targets). Yield (i, costs from source to targets) using self.jobs processes.
+    #The heightfield backend computes the costs of many sources at once : each process gets a chunk of rows.
+    def computeDistanceRows(self, model, rows):
+        multiSource = self.terrainBackend == "heightfield"
+        if multiSource and (self.jobs <= 1 or len(rows) < 2):
+            logging.info("Computing the distance map of %s from %d sources" % (model, len(rows)))
+            for i,costs in _multiSourceRows(self.getTerrain(model), rows):
+                yield i, costs
+            return
+
+        if self.jobs <= 1 or len(rows) < 2:
+            g = self.getTerrain(model)
+            for count,(i,source,targets) in enumerate(rows):
+                logging.debug("Using gladys for computing distance map of %s %d / %d" % (model,count,len(rows)))
+                yield i, g.single_source_all_costs(source, targets)
+            return
+
+        logging.info("Using %d processes for computing distance map of %s" % (self.jobs, model))
+        #the rasters and the cost graph are put in the shared store before the workers start, so that they all map them
+        self.getTerrain(model).prepareCosts()
+        pool = multiprocessing.Pool(self.jobs, _initDistanceWorker, (self.terrainPool.rasters, self.terrainBackend) + self.terrainFiles[model])
+        try:
+            if multiSource:
+                size = max(1, len(rows) // (4 * self.jobs))
+                for result in pool.imap_unordered(_computeDistanceRows, [rows[k:k + size] for k in range(0, len(rows), size)]):
+                    for i,costs in result:
+                        yield i, costs
+                return
+
+            for count,(i,costs) in enumerate(pool.imap_unordered(_computeDistanceRow, rows)):
+                logging.debug("Using gladys for computing distance map of %s %d / %d" % (model,count,len(rows)))
+                yield i, costs
+        finally:
+            pool.close()
+            pool.join()
 
     def getGladysDistance(self, model, start, end):
         if not self.useGladysForModel(model):
             logging.error("Error : call gladys distance for %s" % model)
             sys.exit(1)
 
-        key = "%s_%s_%s_%s" % (start["x"], start["y"], end["x"], end["y"])
-        cost = self.distanceMap[model].get(key, None)
-        if cost is not None:
-            return cost
-        
-        key = "%s_%s_%s_%s" % (end["x"], end["y"], start["x"], start["y"])
-        cost = self.distanceMap[model].get(key, None)
-        if cost is not None:
-            return cost
-        
-        logging.error(sorted(self.distanceMap.keys()))
-        raise ErrorDistanceMap("Cannot find key %s" % key)
+        try:
+            i = self.getDistanceMap().getIndex(model, (start["x"], start["y"]))
+            j = self.getDistanceMap().getIndex(model, (end["x"], end["y"]))
+        except KeyError:
+            raise ErrorDistanceMap("Cannot find %s,%s -> %s,%s in the distance map of %s" % (start["x"], start["y"], end["x"], end["y"], model))
+
+        cost = self.getDistanceMap().get(model, i, j)
+        if math.isnan(cost):
+            raise ErrorDistanceMap("Unknown distance %s,%s -> %s,%s in the distance map of %s" % (start["x"], start["y"], end["x"], end["y"], model))
+        return float(cost)
 
     def getModelList(self):
-        return list(self.mission["models"].keys())
+        return list(self.missionModel.models.keys())
 
     def useGladysForModel(self, model):
         return False
         return model in ["mana", "minnie", "effibot"]
 
     def getRobotList(self):
-        return list(self.mission["agents"].keys())
+        return list(self.missionModel.agents.keys())
     
     def getRobotModel(self, r):
-        return self.mission["agents"][r]["model"]
+        return self.missionModel.agents[r].model
         
     def getRobotName(self, robot):
         return robot
     
     # A wp is a tuple (wp_group, index)
     def getLocName(self, wp):
-        pt = self.mission["wp_groups"][wp[0]]["waypoints"][wp[1]]
-        if "z" in pt:
-            return "%s_%d_%d_%d" % (wp[0], pt["x"]*100, pt["y"]*100, pt["z"]*100)
-        else:
-            return "%s_%d_%d" % (wp[0], pt["x"]*100, pt["y"]*100)
+        group = self.missionModel.groups[wp[0]]
+        return group.names[group.ids[wp[1]]]
 
     def getLocsOfRobot(self, robot):
-        groupName = self.mission["agents"][robot]["wp_group"]
-        return [(groupName, i) for i in self.mission["wp_groups"][groupName]["waypoints"].keys()]
+        group = self.missionModel.getGroupOfAgent(robot)
+        return [(group.name, i) for i in group.indexes]
 
+    #the AAV fly at 40m
     def getTupleLoc(self, wp):
-        pt = self.mission["wp_groups"][wp[0]]["waypoints"][wp[1]]
-        
-        if "ressac" in wp[0]:
-            return (pt["x"], pt["y"], 40)
-        else:
-            return (pt["x"], pt["y"], 0)
-        
-        if "z" in pt:
-            return (pt["x"], pt["y"], pt["z"])
-        else:
-            return (pt["x"], pt["y"])
+        group = self.missionModel.groups[wp[0]]
+        return group.locs[group.ids[wp[1]]]
+
+    def getCoordsOfLocs(self, locs):
+        coords = np.zeros((len(locs), 2))
+        for k,wp in enumerate(locs):
+            group = self.missionModel.groups[wp[0]]
+            i = group.ids[wp[1]]
+            coords[k] = (group.x[i], group.y[i])
+        return coords
 
     def computeDistance(self, robot, pt1, pt2):
-        start = self.mission["wp_groups"][pt1[0]]["waypoints"][pt1[1]]
-        end   = self.mission["wp_groups"][pt2[0]]["waypoints"][pt2[1]]
-        
-        if self.useGladysForModel(self.getRobotModel(robot)):
-            return self.getGladysDistance(self.mission["agents"][robot]["model"], start, end)
-        elif "ressac" in robot:
-            dist = math.sqrt(math.pow(start["x"] - end["x"], 2) + math.pow(start["y"] - end["y"], 2))
-            if dist >= speedAAV*speedAAV/accAAV:
-                duration = dist/speedAAV + speedAAV/accAAV
-            else:
-                raise PathTooShort
-                    
-            return duration + motionDelayAAV
+        return float(self.computeCostMatrix(robot, self.getCoordsOfLocs([pt1, pt2]))[0,1])
+
+    #coords is an array of the (x,y) of waypoints of robot.
+    #Return the matrix of the motion costs between all these waypoints
+    def computeCostMatrix(self, robot, coords):
+        model = self.getRobotModel(robot)
+
+        if self.useGladysForModel(model):
+            try:
+                indexes = [self.getDistanceMap().getIndex(model, (x, y)) for x,y in coords.tolist()]
+            except KeyError as e:
+                raise ErrorDistanceMap("Cannot find %s in the distance map of %s" % (e, model))
+            return np.array(self.getDistanceMap().matrix[model][np.ix_(indexes, indexes)])
+
+        dx = coords[:,0,np.newaxis] - coords[np.newaxis,:,0]
+        dy = coords[:,1,np.newaxis] - coords[np.newaxis,:,1]
+        dist = np.sqrt(dx*dx + dy*dy)
+
+        if "ressac" in robot:
+            return aavMotionDuration(dist)
         else:
-            dist = math.sqrt(math.pow(start["x"] - end["x"], 2) + math.pow(start["y"] - end["y"], 2))
-            velocity = self.mission["models"][self.mission["agents"][robot]["model"]]["robot"]["velocity"]
+            velocity = self.missionModel.models[model].velocity
             return dist / velocity
 
     
     # A wp is just the index of the point
     def getObsLocName(self, wp):
-        pt = self.mission["mission_goal"]["observation_points"][wp]
-        return "ptobs_%d_%d" % (pt["x"]*100, pt["y"]*100)
+        obs = self.missionModel.observations
+        return obs.names[obs.ids[wp]]
 
     def getTupleObs(self, wp):
-        pt = self.mission["mission_goal"]["observation_points"][wp]
-        return (pt["x"], pt["y"], 1)
-        if "z" in pt:
-            return (pt["x"], pt["y"], pt["z"])
-        else:
-            return (pt["x"], pt["y"])
+        obs = self.missionModel.observations
+        return obs.locs[obs.ids[wp]]
+
+    def getObsList(self):
+        return list(self.missionModel.observations.indexes)
+
+    #Compute (once per run) the visibility between all the waypoints of a group and all the observation points
+    #for a given model. The result is shared by the problem and the helper generation.
+    def getVisibilityMatrix(self, model, groupName):
+        key = (model, groupName)
+        if key not in self.visibility:
+            g = self.getTerrain(model)
+            group = self.missionModel.groups[groupName]
+            observations = self.missionModel.observations
+            wpIndexes = group.indexes
+            obsList = observations.indexes
+            matrix = np.zeros((len(wpIndexes), len(obsList)), dtype=bool)
+
+            #the pairs that are not known from a previous run are evaluated in one batch
+            pairs = []
+            for i,index in enumerate(wpIndexes):
+                for j,obs in enumerate(obsList):
+                    known = self.visibilitySeed.get((model, groupName, index, obs), None)
+                    if known is not None:
+                        matrix[i,j] = known
+                    else:
+                        pairs.append((i,j))
+
+            if pairs:
+                rows, cols = zip(*pairs)
+                matrix[rows, cols] = g.is_visible_batch([group.locs[i] for i in rows], [observations.locs[j] for j in cols])
+
+            logging.debug("Visibility matrix of %s on %s : %d visible out of %d" % (model, groupName, matrix.sum(), matrix.size))
+            self.visibility[key] = matrix
+
+        return self.visibility[key]
+
+    #Coverage index of a group : bit j of the mask of waypoint i is set if i sees the observation point of id j
+    def getCoverage(self, model, groupName):
+        key = (model, groupName)
+        if key not in self.coverage:
+            packed = np.packbits(self.getVisibilityMatrix(model, groupName), axis=1, bitorder="little")
+            self.coverage[key] = [int.from_bytes(row.tobytes(), "little") for row in packed]
+        return self.coverage[key]
+
+    def isVisible(self, robot, wp, obs):
+        matrix = self.getVisibilityMatrix(self.getRobotModel(robot), wp[0])
+        return matrix[self.missionModel.groups[wp[0]].ids[wp[1]], self.missionModel.observations.ids[obs]]
+
+    #Reduction of the problem, computed once if reduceProblem is set. None otherwise
+    def getReduction(self):
+        if self.reduceProblem and self.reduction is None:
+            self.reduction = reduction.reduceProblem(self)
+        return self.reduction
+
+    #Waypoints of robot written in the problem
+    def getProblemLocsOfRobot(self, robot):
+        r = self.getReduction()
+        return self.getLocsOfRobot(robot) if r is None else r.locs[robot]
+
+    #Observation points written in the problem
+    def getProblemObsList(self):
+        r = self.getReduction()
+        return self.getObsList() if r is None else r.obsList
 
     def getInitialPos(self, robot):
-        return (self.mission["agents"][robot]["wp_group"], self.initIndex[robot])
+        agent = self.missionModel.agents[robot]
+        return (agent.group, agent.initIndex)
+
+    #Inputs of each generated artifact, used by the build cache to know if it has to be rebuilt
+    def getArtifactInputs(self, artifact):
+        m = self.mission
+        agents = dict((a, {"model": v["model"], "wp_group": v["wp_group"], "position": v["position"], "spare": v["spare"]}) for a,v in m["agents"].items())
+        terrain = dict((model, [self.terrainTag] + [querycache.fileDigest(f) for f in files]) for model,files in self.terrainFiles.items())
+        motion = {"speedAAV": speedAAV, "accAAV": accAAV, "motionDelayAAV": motionDelayAAV,
+                  "gladys": [model for model in self.getModelList() if self.useGladysForModel(model)],
+                  "sparse": self.sparseMotion, "neighbours": self.motionNeighbours}
+        geometry = {"agents": agents, "wp_groups": m["wp_groups"], "models": m["models"], "terrain": terrain, "motion": motion}
+        #the reduction keeps the points of the communication goals
+        reduced = {"communication_goals": m["mission_goal"]["communication_goals"]} if self.reduceProblem else None
+
+        if artifact == "domain":
+            return {"models": self.getModelList(), "initActionLength": initActionLength, "costExploreAction": costExploreAction}
+        elif artifact == "problem":
+            geometry["observation_points"] = m["mission_goal"]["observation_points"]
+            geometry["reduction"] = reduced
+            return geometry
+        elif artifact == "helper":
+            geometry["observation_points"] = m["mission_goal"]["observation_points"]
+            geometry["patrols"] = {"useAAVPatrol": self.useAAVPatrol, "useAGVPatrol": self.useAGVPatrol}
+            geometry["reduction"] = reduced
+            return geometry
+        elif artifact == "planInit":
+            geometry["communication_goals"] = m["mission_goal"]["communication_goals"]
+            geometry["initActionLength"] = initActionLength
+            return geometry
+        elif artifact == "morse":
+            return {"agents": agents, "models": m["models"], "home_dir": m["home_dir"], "blender_file": m["map_data"].get("blender_file", None),
+                    "speedAAV": speedAAV, "MorseFastmode": MorseFastmode}
+        elif artifact in ["vnet", "launch", "roslaunch"]:
+            return {"agents": agents}
+        else:
+            raise ValueError("Unknown artifact %s" % artifact)
 
     def getDomainString(self):
+        return self.getDomain().toString()
+
+    def getDomain(self):
     
         d = pddl.Domain("action")
         d.addRequirement("strips")
@@ -419,20 +523,26 @@ class ProblemGenerator:
         d.addAction(a)
         ###
         
-        return d.toString()
+        return d
 
-    def getProblemString(self):
+    #The facts of the returned problem are generated while it is written
+    def getProblem(self):
     
         p = pddl.Problem("action-prb", "action")
 
         ####  Objects ####
         for r in self.getRobotList():
-            p.addObject(self.getRobotName(r), self.mission["agents"][r]["model"])
+            p.addObject(self.getRobotName(r), self.getRobotModel(r))
         
-        for index,group in self.mission["wp_groups"].items():
-            [p.addObject(self.getLocName((index, i)), "loc-wp") for i in group["waypoints"].keys()]
+        if self.getReduction() is None:
+            for group in self.missionModel.groups.values():
+                [p.addObject(name, "loc-wp") for name in group.names]
+        else:
+            kept = set(wp for r in self.getRobotList() for wp in self.getProblemLocsOfRobot(r))
+            for group in self.missionModel.groups.values():
+                [p.addObject(group.names[group.ids[i]], "loc-wp") for i in group.indexes if (group.name, i) in kept]
 
-        [p.addObject(self.getObsLocName(l), "loc-obs") for l in self.mission["mission_goal"]["observation_points"].keys()]
+        [p.addObject(self.getObsLocName(obs), "loc-obs") for obs in self.getProblemObsList()]
 
         ### Init position ###
 
@@ -442,92 +552,192 @@ class ProblemGenerator:
         ### Points allowed ###
 
         for robot in self.getRobotList():
-            groupName = self.mission["agents"][robot]["wp_group"]
-            for index in self.mission["wp_groups"][groupName]["waypoints"].keys():
-                p.addInits("robot-allowed {robot} {pt}".format(robot=robot, pt=self.getLocName((groupName, index))))
+            for pt in self.getProblemLocsOfRobot(robot):
+                p.addInits("robot-allowed {robot} {pt}".format(robot=robot, pt=self.getLocName(pt)))
 
         ####  Distance for motion ####
 
-        for robot in self.getRobotList():
-            for pt1,pt2 in itertools.combinations(sorted(self.getLocsOfRobot(robot)), r=2):
-                cost = self.computeDistance(robot, pt1, pt2)
-                if cost != 0 and cost != float("inf"):
-                    p.addInits("= (distance {start} {end}) {cost}) (adjacent {start} {end}".format(start=self.getLocName(pt1),end=self.getLocName(pt2),cost=cost) )
-                    p.addInits("= (distance {start} {end}) {cost}) (adjacent {start} {end}".format(start=self.getLocName(pt2),end=self.getLocName(pt1),cost=cost) )
+        self.addMotionFacts(p)
     
         ####  visibility for observation ####
 
+        p.addInitGenerator(self.getVisibilityFacts())
+
+        ####  visibility for communication ####
+
+        p.addInitGenerator(self.getComFacts())
+
+        ####  Goals ####
+        
+        p.addGoals(*["explored %s" % self.getObsLocName(obs) for obs in self.getProblemObsList()])
+
+        return p
+
+    def getProblemString(self):
+        return self.getProblem().toString()
+
+    #Register the distance and adjacent facts of each robot in p, from its cost matrix
+    def addMotionFacts(self, p):
+        for robot in self.getRobotList():
+            locs = sorted(self.getProblemLocsOfRobot(robot))
+            costs = self.computeCostMatrix(robot, self.getCoordsOfLocs(locs))
+            ids = np.array(p.intern([self.getLocName(l) for l in locs]), dtype=np.int64)
+
+            valid = np.isfinite(costs) & (costs != 0)
+            if self.sparseMotion:
+                costs, valid = self.getSparseMotion(robot, locs, costs, valid)
+            i, j = np.nonzero(np.triu(valid, 1))
+
+            #both directions of each pair, one after the other
+            start = np.stack([ids[i], ids[j]], axis=1).ravel()
+            end = np.stack([ids[j], ids[i]], axis=1).ravel()
+            values = np.repeat(costs[i,j], 2)
+
+            p.addFactsBulk("distance", [start, end], values)
+            p.addFactsBulk("adjacent", [start, end])
+
+    #Sparse motion graph of robot over the waypoints locs. Return the costs to write and the edges kept.
+    #The moves between the consecutive points of the patrols are always kept, as the helper uses them.
+    def getSparseMotion(self, robot, locs, costs, valid):
+        dist, edges = motiongraph.sparseGraph(costs, valid, self.motionNeighbours)
+
+        position = dict((wp, i) for i,wp in enumerate(locs))
+        group = self.missionModel.getGroupOfAgent(robot)
+        for patrol in group.patrols.values():
+            for f,t in zip(patrol, patrol[1:]):
+                i, j = position.get((group.name, f)), position.get((group.name, t))
+                if i is not None and j is not None and np.isfinite(dist[i,j]) and i != j:
+                    edges[i,j] = edges[j,i] = True
+
+        logging.info("Sparse motion graph of %s : %d/%d motions kept" % (robot, np.triu(edges, 1).sum(), np.triu(valid, 1).sum()))
+        return dist, edges
+
+    def getVisibilityFacts(self):
         count = 0
-        for ptObs in self.mission["mission_goal"]["observation_points"].keys():
-            isVisible = False
-            isVisiblePatrol = False
+        observations = self.missionModel.observations
+        robots = self.getRobotList()
+
+        r = self.getReduction()
+        written = set(self.getProblemObsList())
+
+        #observation points seen from any written waypoint and from a patrol point, as bitmasks
+        visible = 0
+        visiblePatrol = 0
+        rows = {} #key:robot. Value : ids of the written waypoints
+        for robot in robots:
+            group = self.missionModel.getGroupOfAgent(robot)
+            coverage = self.getCoverage(self.getRobotModel(robot), group.name)
+            rows[robot] = [group.ids[wp[1]] for wp in self.getProblemLocsOfRobot(robot)]
+            for i in rows[robot]:
+                visible |= coverage[i]
+            for patrol in group.patrols.values():
+                if r is None or r.keepsPatrol(robot, [(group.name, index) for index in patrol]):
+                    for index in patrol:
+                        visiblePatrol |= coverage[group.ids[index]]
+
+        for j,ptObs in enumerate(observations.indexes):
             visibleFrom = []
-            
-            for robot in self.getRobotList():
-                model = self.getRobotModel(robot)
-                
-                for ptMove in self.getLocsOfRobot(robot):
-                    if self.gladys[model].is_visible(self.getTupleLoc(ptMove), self.getTupleObs(ptObs)):
-                        p.addInits("visible %s %s %s" %(robot, self.getLocName(ptMove), self.getObsLocName(ptObs)))
+            for robot in robots:
+                group = self.missionModel.getGroupOfAgent(robot)
+                matrix = self.getVisibilityMatrix(self.getRobotModel(robot), group.name)
+                for i in np.flatnonzero(matrix[rows[robot], j]):
+                    name = group.names[rows[robot][i]]
+                    if ptObs in written:
+                        yield "visible %s %s %s" %(robot, name, observations.names[j])
                         count += 1
-                        isVisible = True
-                        visibleFrom.append(self.getLocName(ptMove))
-        
-                        for patrolName, patrol in self.mission["wp_groups"][ptMove[0]]["patrols"].items():
-                            if ptMove[1] in patrol:
-                                isVisiblePatrol = True
+                    visibleFrom.append(name)
 
-            if not isVisible:
-                logging.error("Cannot see observation point %s from any point" % self.getObsLocName(ptObs))
+            if not visible >> j & 1:
+                logging.error("Cannot see observation point %s from any point" % observations.names[j])
                 self.canLaunchHiPOP = False
-            if not isVisiblePatrol:
-                logging.error("Cannot see observation point %s with a patrol" % self.getObsLocName(ptObs))
+            if not visiblePatrol >> j & 1:
+                logging.error("Cannot see observation point %s with a patrol" % observations.names[j])
                 logging.error("Visible from : %s" % visibleFrom)
                 self.canLaunchHiPOP = False
     
         logging.info("Found %d visibility links" % count)
 
-        ####  visibility for communication ####
+    #Tell the query cache that the visibility and communication queries of all the robots were made
+    def setQueriesComplete(self):
+        for model in set(self.getRobotModel(robot) for robot in self.getRobotList()):
+            for kind in ["v", "c"]:
+                self.queryCache.setComplete(self.queryContexts[model], kind)
 
+    def getComFacts(self):
         count = 0
-        for robot1, robot2 in itertools.product(self.getRobotList(), self.getRobotList()):
-            points1 = self.getLocsOfRobot(robot1)
-            points2 = self.getLocsOfRobot(robot2)
-            canCommunicate = False
-            
-            for pt1, pt2 in itertools.product(points1, points2):
-                if self.canRobotsCommunicate(robot1, robot2, pt1, pt2):
-                    p.addInits("visible-com {robot1} {robot2} {pt1} {pt2}".format(robot1=robot1, robot2=robot2, pt1=self.getLocName(pt1), pt2=self.getLocName(pt2)))
-                    count += 1
-                    canCommunicate = True
-    
-            if not canCommunicate:
+        for robot1, robot2 in itertools.combinations(self.getRobotList(), 2):
+            links = self.getComLinks(robot1, robot2)
+            if self.getReduction() is not None:
+                kept1 = set(self.getProblemLocsOfRobot(robot1))
+                kept2 = set(self.getProblemLocsOfRobot(robot2))
+                links = [(pt1, pt2) for pt1, pt2 in links if pt1 in kept1 and pt2 in kept2]
+
+            for pt1, pt2 in links:
+                yield "visible-com {robot1} {robot2} {pt1} {pt2}".format(robot1=robot1, robot2=robot2, pt1=self.getLocName(pt1), pt2=self.getLocName(pt2))
+                yield "visible-com {robot2} {robot1} {pt2} {pt1}".format(robot1=robot1, robot2=robot2, pt1=self.getLocName(pt1), pt2=self.getLocName(pt2))
+                count += 2
+
+            if not links:
                 logging.warning("Robots %s and %s cannot communicate" % (self.getRobotName(robot1), self.getRobotName(robot2)))
                 #self.canLaunchHiPOP = False
         logging.info("Found %d com links" % count)
 
-
-        ####  Goals ####
-        
-        p.addGoals(*["explored %s" % self.getObsLocName(wp) for wp in self.mission["mission_goal"]["observation_points"].keys()])
-
-        return p.toString()
+    #Maximum distance at which two robots can communicate, None if unknown
+    def getComRange(self, robot1, robot2):
+        ranges = [self.missionModel.getModelOfAgent(r).antennaRange for r in [robot1, robot2]]
+        ranges = [r for r in ranges if r is not None]
+        if not ranges:
+            return None
+        return min(ranges)
+
+    #Return the list of (pt1, pt2) such that robot1 at pt1 can communicate with robot2 at pt2.
+    #The test is symmetric : the same list is valid for robot2 and robot1 with reversed points.
+    #Each pair of (model, waypoint) is evaluated only once per run.
+    def getComLinks(self, robot1, robot2):
+        points1 = self.getLocsOfRobot(robot1)
+        points2 = self.getLocsOfRobot(robot2)
+        model1 = self.getRobotModel(robot1)
+        model2 = self.getRobotModel(robot2)
+
+        coords1 = [self.getTupleLoc(pt) for pt in points1]
+        coords2 = [self.getTupleLoc(pt) for pt in points2]
+        key = lambda i, j: tuple(sorted([(model1,) + points1[i], (model2,) + points2[j]]))
+
+        pairs = list(comlinks.candidatePairs(coords1, coords2, self.getComRange(robot1, robot2)))
+        unknown = dict((key(i, j), (i,j)) for i,j in pairs if key(i, j) not in self.comLinks)
+        if unknown:
+            ij = list(unknown.values())
+            for k,value in zip(unknown.keys(), self.canRobotsCommunicateBatch(robot1, robot2, [points1[i] for i,j in ij], [points2[j] for i,j in ij])):
+                self.comLinks[k] = bool(value)
+
+        return [(points1[i], points2[j]) for i,j in pairs if self.comLinks[key(i, j)]]
 
     def canRobotsCommunicate(self, robot1, robot2, pt1, pt2):
-        g1 = self.gladys[self.mission["agents"][robot1]["model"]]
-        g2 = self.gladys[self.mission["agents"][robot2]["model"]]
-        antennaHeight1 = self.mission["models"][self.mission["agents"][robot1]["model"]]["antenna"]["pose"]["z"]
-        antennaHeight2 = self.mission["models"][self.mission["agents"][robot2]["model"]]["antenna"]["pose"]["z"]
-
-        p = self.getTupleLoc(pt1)
-        posAntenna1 = (p[0], p[1], p[2] + antennaHeight1)
-
-        p = self.getTupleLoc(pt2)
-        posAntenna2 = (p[0], p[1], p[2] + antennaHeight2)
-
-        return g1.can_communicate(self.getTupleLoc(pt1), posAntenna2) and g2.can_communicate(self.getTupleLoc(pt2), posAntenna1)
+        return self.canRobotsCommunicateBatch(robot1, robot2, [pt1], [pt2])[0]
+
+    #Batch version of canRobotsCommunicate over the pairs (points1[k], points2[k]). Return a boolean array
+    def canRobotsCommunicateBatch(self, robot1, robot2, points1, points2):
+        g1 = self.getTerrain(self.getRobotModel(robot1))
+        g2 = self.getTerrain(self.getRobotModel(robot2))
+        antennaHeight1 = self.missionModel.getModelOfAgent(robot1).antennaHeight
+        antennaHeight2 = self.missionModel.getModelOfAgent(robot2).antennaHeight
+
+        locs1 = [self.getTupleLoc(pt) for pt in points1]
+        locs2 = [self.getTupleLoc(pt) for pt in points2]
+        posAntenna1 = [(p[0], p[1], p[2] + antennaHeight1) for p in locs1]
+        posAntenna2 = [(p[0], p[1], p[2] + antennaHeight2) for p in locs2]
+
+        #robot2 is asked only for the pairs accepted by robot1
+        result = np.array(g1.can_communicate_batch(locs1, posAntenna2), dtype=bool)
+        k = np.nonzero(result)[0]
+        if len(k):
+            result[k] = g2.can_communicate_batch([locs2[i] for i in k], [posAntenna1[i] for i in k])
+        return result
 
     def getHelperString(self):
+        return self.getHelper().toString()
+
+    def getHelper(self):
 
         h = pddl.Helper("action")
         h.addOption("abstractOnly")
@@ -537,10 +747,10 @@ class ProblemGenerator:
         h.addAllowedAction("communicate")
         h.addAllowedAction("communicate-meta")
         h.addAllowedAction("has-communicated")
-        if not useAAVPatrol:
+        if not self.useAAVPatrol:
             logging.error("Impossible d'autoriser les observe des AAV mais pas des AGV")
             h.addAllowedAction("observe")
-        if not useAGVPatrol:
+        if not self.useAGVPatrol:
             logging.error("Impossible d'autoriser les observe des AGV mais pas des AAV")
             h.addAllowedAction("observe")
 
@@ -550,44 +760,45 @@ class ProblemGenerator:
             for p in l:
                 h.addAction(p)
 
-        return h.toString()
+        return h
 
 
     def getPatrolActions(self, robot):
         result = []
-        wpGroupName = self.mission["agents"][robot]["wp_group"]
-        g = self.gladys[self.mission["agents"][robot]["model"]]
+        wpGroup = self.missionModel.getGroupOfAgent(robot)
+        wpGroupName = wpGroup.name
+        coverage = self.getCoverage(self.getRobotModel(robot), wpGroupName)
+        obsNames = self.missionModel.observations.names
+        r = self.getReduction()
+        obsMask = -1 if r is None else r.obsMask #the merged observation points are explored with the one they are merged into
         
-        for patrolName,direct in itertools.product(self.mission["wp_groups"][wpGroupName]["patrols"].keys(), [True, False]):
-            patrol = [(wpGroupName, i) for i in self.mission["wp_groups"][wpGroupName]["patrols"][patrolName]]
+        for patrolName,direct in itertools.product(wpGroup.patrols.keys(), [True, False]):
+            patrol = [(wpGroupName, i) for i in wpGroup.patrols[patrolName]]
             if not direct:
                 patrol.reverse()
             
             if not direct and len(patrol) < 2:
                 continue #direct and indirect are the same if there is only one point
+
+            if r is not None and not r.keepsPatrol(robot, patrol):
+                if direct:
+                    logging.warning("Patrol %s of group %s goes through waypoints dropped by the reduction. Ignoring it" % (patrolName,wpGroupName))
+                continue
             
-            wpList = self.mission["wp_groups"][self.mission["agents"][robot]["wp_group"]]["waypoints"]
             start = patrol[0]
             end = patrol[-1]
             
-            obs = {} #key:point name. Value : list of obs point
+            #bitmask of the obs points seen from each point. Only the first point seeing an obs point keeps it
+            obs = {} #key:point name. Value : bitmask of obs point ids
             for pt in patrol:
-                listObs = [obsPt for obsPt in self.mission["mission_goal"]["observation_points"].keys() if g.is_visible(self.getTupleLoc(pt), self.getTupleObs(obsPt))]
+                if coverage[wpGroup.ids[pt[1]]] & obsMask:
+                    obs[self.getLocName(pt)] = coverage[wpGroup.ids[pt[1]]] & obsMask
 
-                if len(listObs) > 0:
-                    obs[self.getLocName(pt)] = listObs
-        
-            #clean the list : keep only one point for each observation
-            seenPt = set()
-            for k,v in obs.items():
-                for pt in list(v): #copy it
-                    if pt in seenPt:
-                        v.remove(pt)
-                    else:
-                        seenPt.add(pt)
-            
+            seen = 0
             for k in list(obs.keys()):
-                if len(obs[k]) == 0:
+                obs[k] &= ~seen
+                seen |= obs[k]
+                if not obs[k]:
                     del obs[k]
         
             a = pddl.Action("patrol_%s_%s__%s__%s" % (robot, patrolName, self.getLocName(start), self.getLocName(end)))
@@ -597,11 +808,11 @@ class ProblemGenerator:
 
             a.addPrec("at-r %s %s" % (robot, self.getLocName(start)))
 
-            if len(obs) == 0:
+            if not seen:
                 logging.warning("Patrol %s of group %s cannot see any observation point. Ignoring it" % (patrolName,wpGroupName))
                 
-            for obsPoint in set(reduce(lambda x,y : x + y, obs.values(), [])):
-                a.addEffs("explored " + self.getObsLocName(obsPoint))
+            for j in bitsOf(seen):
+                a.addEffs("explored " + obsNames[j])
             a.addEff("at-r %s %s" % (robot, self.getLocName(end))) #Pas de side effect : on veut pouvoir l'introduire pour le mouvement et resoudre des buts de maniere opportuniste en presence de deadline
 
             if direct:
@@ -631,22 +842,26 @@ class ProblemGenerator:
                 m.addCausalLink(":init", ":goal", "at-r %s %s" % (robot, self.getLocName(start)))
                     
             #Add the observe actions
+            first = {} #key:point. Value : first position in the patrol
+            for i,mvPt in enumerate(patrol):
+                first.setdefault(mvPt, i)
+
             exploreId = -1
             for i,mvPt in zip(range(len(patrol)), patrol):
-                for obsPt in obs.get(self.getLocName(mvPt), []):
+                for j in bitsOf(obs.get(self.getLocName(mvPt), 0)):
                     exploreId += 1
-                    m.addAction("explore-%d" % exploreId, "observe %s %s %s" % (robot, self.getLocName(mvPt), self.getObsLocName(obsPt)))
+                    m.addAction("explore-%d" % exploreId, "observe %s %s %s" % (robot, self.getLocName(mvPt), obsNames[j]))
             
-                    m.addCausalLink("explore-%d" % exploreId, ":goal", "explored %s" % self.getObsLocName(obsPt))
+                    m.addCausalLink("explore-%d" % exploreId, ":goal", "explored %s" % obsNames[j])
             
                     if mvPt == patrol[0]:
                         s = ":init"
                     else:
-                        s = "move-%d" % (patrol.index(mvPt) - 1)
+                        s = "move-%d" % (first[mvPt] - 1)
                     m.addCausalLink(s, "explore-%d" % exploreId, "at-r %s %s" % (robot, self.getLocName(mvPt)))
                 
                     if mvPt != patrol[-1]:
-                        m.addTemporalLink("explore-%d" % exploreId, "move-%d" % (patrol.index(mvPt)))
+                        m.addTemporalLink("explore-%d" % exploreId, "move-%d" % first[mvPt])
             
             a.addMethod(m)
 
@@ -670,7 +885,7 @@ class ProblemGenerator:
         
         #add init action
         for robot in self.getRobotList():
-            if self.mission["agents"][robot]["spare"] or robot in []:
+            if self.missionModel.agents[robot].spare or robot in []:
                 logging.info("Adding an init action for %s" % robot)
                 
                 actionIndex = str(len(result["actions"]))
@@ -722,8 +937,8 @@ class ProblemGenerator:
                     nextTimepoint += 2
 
                 else:
-                    pt1 = (self.mission["agents"][c["agent1"]]["wp_group"], c["wp_1"])
-                    pt2 = (self.mission["agents"][c["agent2"]]["wp_group"], c["wp_2"])
+                    pt1 = (self.missionModel.agents[c["agent1"]].group, c["wp_1"])
+                    pt2 = (self.missionModel.agents[c["agent2"]].group, c["wp_2"])
                     
                     if not self.canRobotsCommunicate(c["agent1"], c["agent2"], pt1, pt2):
                         logging.error("Com impossible between %s and %s at %s and %s" %(c["agent1"], c["agent2"], self.getLocName(pt1), self.getLocName(pt2)))
@@ -785,8 +1000,8 @@ class ProblemGenerator:
         return json.dumps(result)
     
     def writeHiPOPLaunchFile(self, f, data):
-        nonSpareAgents = [agent for agent in self.mission["agents"] if not self.mission["agents"][agent].get("spare", False)]
-        spareAgents = [agent for agent in self.mission["agents"] if self.mission["agents"][agent].get("spare", False)]
+        nonSpareAgents = [agent.name for agent in self.missionModel.agents.values() if not agent.spare]
+        spareAgents = [agent.name for agent in self.missionModel.agents.values() if agent.spare]
 
         logging.info("There is %d robots with %s additional spare robots" % (len(nonSpareAgents), len(spareAgents)))
         
@@ -808,13 +1023,13 @@ class ProblemGenerator:
         robots = []
         for r in self.getRobotList():
             if "ressac" in r:
-                robots.append("%s = Ressac(%d, %d) #,teleport=True)" % (r, self.mission["agents"][r]["position"]["x"], self.mission["agents"][r]["position"]["y"]))
+                robots.append("%s = Ressac(%d, %d) #,teleport=True)" % (r, self.missionModel.agents[r].position["x"], self.missionModel.agents[r].position["y"]))
             else:
-                robots.append("%s = AGV(%d, %d) #,teleport=True)" % (r, self.mission["agents"][r]["position"]["x"], self.mission["agents"][r]["position"]["y"]))
+                robots.append("%s = AGV(%d, %d) #,teleport=True)" % (r, self.missionModel.agents[r].position["x"], self.missionModel.agents[r].position["y"]))
             
         speedAGV = 1
-        if "mana" in self.mission["models"]:
-            speedAGV = self.mission["models"]["mana"]["robot"]["velocity"]
+        if "mana" in self.missionModel.models:
+            speedAGV = self.missionModel.models["mana"].velocity
     
         s = os.path.expandvars("$ACTION_HOME")
         morseFilepath = os.path.join(self.mission["home_dir"].replace(s, "$ACTION_HOME"), self.mission["map_data"]["blender_file"])
@@ -874,11 +1089,11 @@ env.set_camera_speed(100)
 env.create()
 """.format(robots="\n".join(robots), speedAGV=speedAGV, speedAAV= speedAAV, fastmode=MorseFastmode, morseFilepath=morseFilepath))
 
-    #write in the current working directory
-    def writeRoslaunchFiles(self, pathToMission, data, missionName):
+    #write in folder (the current working directory by default)
+    def writeRoslaunchFiles(self, pathToMission, data, missionName, folder = "."):
         pathToMission = pathToMission.replace("$ACTION_HOME", "$(env ACTION_HOME)")
 
-        with open("hidden-params.launch", "w") as f:
+        with open(os.path.join(folder, "hidden-params.launch"), "w") as f:
             f.write("""
 <launch>
     <param name="hidden/plan"        type="str" textfile="{plan}" />
@@ -896,7 +1111,7 @@ env.create()
            vnet  =os.path.join(pathToMission, "vnet_config.yaml")))
         
         
-        with open("mission.launch", "w") as f:
+        with open(os.path.join(folder, "mission.launch"), "w") as f:
             f.write("<launch>\n")
 
             f.write("""
@@ -949,7 +1164,7 @@ env.create()
 
             f.write("</launch>\n")
 
-        with open("stats_simu.launch", "w") as f:
+        with open(os.path.join(folder, "stats_simu.launch"), "w") as f:
             f.write("<launch>\n")
 
             f.write("""
@@ -995,52 +1210,96 @@ env.create()
 
         yaml.dump(vNetConfig, f)
 
-def setup():
+_workerTerrain = None
+
+#Each worker process of the distance pool holds its own terrain instance. The heightfield terrains
+#map the rasters of the store shared by the generator, gladys reads its files itself
+def _initDistanceWorker(rasters, backend, regionFile, dtmFile, configFile):
+    global _workerTerrain
+    _workerTerrain = terrain.TerrainPool(rasters).get(regionFile, dtmFile, configFile, backend)
+
+def _computeDistanceRow(row):
+    i, source, targets = row
+    return i, list(_workerTerrain.single_source_all_costs(source, targets))
+
+#Costs of the rows (i, source, targets) with one multi-source query. Yield (i, costs)
+def _multiSourceRows(g, rows):
+    targets = sorted(set(t for i,source,rowTargets in rows for t in rowTargets))
+    column = dict((t, k) for k,t in enumerate(targets))
+    costs = g.multi_source_all_costs([source for i,source,rowTargets in rows], targets)
+    for r,(i,source,rowTargets) in enumerate(rows):
+        yield i, costs[r, [column[t] for t in rowTargets]]
+
+def _computeDistanceRows(rows):
+    return list(_multiSourceRows(_workerTerrain, rows))
+
+def getParser():
     parser = argparse.ArgumentParser(description='Create a set of plans for ACTION')
-    parser.add_argument('missionFile', type=str)
+    parser.add_argument('missionFile', type=str, nargs='?')
     parser.add_argument('--outputFolder', type=str, default=None)
     parser.add_argument('-g', '--forceGladys' , action='store_true')
     parser.add_argument('--noAAVPatrols', action='store_true')
     parser.add_argument('--noAGVPatrols', action='store_true')
     parser.add_argument('--force', action='store_true')
+    parser.add_argument('--noQueryCache', action='store_true', help="do not use the on-disk cache of the visibility and communication queries")
+    parser.add_argument('--noBuildCache', action='store_true', help="erase the output folder and regenerate all the files")
+    parser.add_argument('-i', '--incremental', action='store_true', help="update the previous problem, evaluating only the points that changed")
+    parser.add_argument('--sparseMotion', action='store_true', help="only write the motions that are not dominated by a path through another waypoint")
+    parser.add_argument('--neighbours', type=int, default=None, metavar="K", help="with --sparseMotion, only keep the motions to the K nearest waypoints, and the ones needed for connectivity")
+    parser.add_argument('--noHiPOP', action='store_true', help="do not launch HiPOP on the generated files")
+    parser.add_argument('--reduce', action='store_true', help="drop the waypoints and merge the observation points that cannot change the plans before writing the problem")
+    parser.add_argument('--terrainBackend', type=str, default=terrain.defaultBackend, choices=sorted(terrain.backends.keys()), help="implementation of the terrain queries")
+    parser.add_argument('--viewsheds', type=str, default=None, metavar="FOLDER", help="answer the visibility queries with viewsheds, cached in FOLDER (heightfield backend only)")
+    parser.add_argument('--noSnapshot', action='store_true', help="do not use nor write the compiled snapshot of the mission")
+    parser.add_argument('--compile', action='store_true', help="only validate the mission and write its snapshot")
     parser.add_argument('--logLevel',   type=str, default="info")
-    args = parser.parse_args()
-
-    global useAAVPatrol
-    useAAVPatrol = not args.noAAVPatrols
-    global useAGVPatrol
-    useAGVPatrol = not args.noAGVPatrols
-
-    #Configure the logger
-    numeric_level = getattr(logging, args.logLevel.upper(), None)
-    if not isinstance(numeric_level, int):
-        raise ValueError('Invalid log level: %s' % args.logLevel)
-    logging.basicConfig(level=numeric_level, format='%(levelname)s(%(filename)s:%(lineno)d):%(message)s')
-
-    args.missionFile = os.path.abspath(args.missionFile)
-    pathToMission = os.path.splitext(args.missionFile)[0]
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="number of processes used to pre-compute the distances")
+    parser.add_argument('--serve', type=str, default=None, metavar="SOCKET", help="run as a server, waiting for missions on the unix socket SOCKET")
+    return parser
+
+"""
+Prepare the output folder of a mission and create its generator.
+args holds the options of the command line. When interactive, ask before erasing an existing folder.
+Return (generator, build cache, output folder, mission name, path to mission).
+"""
+def setup(args, terrainPool = None, interactive = True):
+    if args.terrainBackend == "gladys" and terrain.gladys is None:
+        logging.error("[error] install gladys [and setup PYTHONPATH], or use another terrain backend")
+        sys.exit(1)
+
+    if args.viewsheds is not None and args.terrainBackend != "heightfield":
+        logging.error("[error] viewsheds can only be used with the heightfield terrain backend")
+        sys.exit(1)
+
+    missionFile = os.path.abspath(args.missionFile)
+    pathToMission = os.path.splitext(missionFile)[0]
     s = os.path.expandvars("$ACTION_HOME")
     pathToMission = pathToMission.replace(s, "$ACTION_HOME")
 
-    args.missionFile = os.path.expandvars(args.missionFile)
-    logging.info("Using mission file : %s" % args.missionFile)
+    missionFile = os.path.expandvars(missionFile)
+    logging.info("Using mission file : %s" % missionFile)
 
-    with open(args.missionFile) as f:
-        mission = json.load(f)
-        
-    mission["home_dir"] = os.path.expandvars(mission["home_dir"])
+    try:
+        mission = missionmodel.loadMission(missionFile, not args.noSnapshot)
+    except missionmodel.InvalidMission as e:
+        logging.error("Invalid mission %s :\n%s" % (missionFile, e))
+        sys.exit(1)
 
     if args.outputFolder is None:
-        outputFolder = os.path.abspath(os.path.splitext(args.missionFile)[0])
+        outputFolder = os.path.abspath(os.path.splitext(missionFile)[0])
     else:
-        outputFolder = args.outputFolder
+        outputFolder = os.path.abspath(args.outputFolder)
 
     logging.info("Output folder : %s" % outputFolder) 
 
-    distanceFileName = "distancemap.json"
+    distanceFileName = "distancemap"
+    queryCacheFileName = "querycache.json"
+    buildCacheFileName = "buildcache.json"
 
-    if os.access(outputFolder, os.R_OK):
-        if not args.force:
+    if os.access(outputFolder, os.R_OK) and not args.noBuildCache and not args.forceGladys:
+        logging.info("Output folder already exists. Only the outdated files will be regenerated")
+    elif os.access(outputFolder, os.R_OK):
+        if not args.force and interactive:
             print("Output folder already exists. Do you want to erase it ? Press enter to continue")
             if sys.version_info.major <= 2:
                 raw_input()
@@ -1048,89 +1307,278 @@ def setup():
                 input()
 
         for f in os.listdir(outputFolder):
-            if f == distanceFileName and not args.forceGladys: continue #if the distances are pre-computed, do not remove them
+            if f in [distanceFileName, distanceFileName + ".json", queryCacheFileName] and not args.forceGladys: continue #if the distances and queries are pre-computed, do not remove them
             s = os.path.join(outputFolder, f)
             if os.path.isdir(s):
                 shutil.rmtree(s)
             else:
                 os.remove(s)
     else:
-        os.mkdir(outputFolder)
+        os.makedirs(outputFolder)
 
     distanceFile = os.path.join(outputFolder, distanceFileName)
+    queryCacheFile = None if args.noQueryCache else os.path.join(outputFolder, queryCacheFileName)
+    cache = buildcache.BuildCache(None if args.noBuildCache else os.path.join(outputFolder, buildCacheFileName))
 
     if outputFolder.endswith("/"):
         missionName = os.path.basename(os.path.split(outputFolder)[0])
     else:
         missionName = os.path.basename(outputFolder)
 
-    p = ProblemGenerator(mission, distanceFile)
-    
-    os.chdir(outputFolder)
-    
-    return p,missionName,pathToMission,args.missionFile
-
-def main():
+    p = ProblemGenerator(mission, distanceFile, queryCacheFile, args.jobs, terrainPool, args.terrainBackend,
+                         None if args.viewsheds is None else os.path.abspath(args.viewsheds))
+    p.useAAVPatrol = not args.noAAVPatrols
+    p.useAGVPatrol = not args.noAGVPatrols
+    p.reduceProblem = args.reduce
+    p.sparseMotion = args.sparseMotion or args.neighbours is not None
+    p.motionNeighbours = args.neighbours
     
-    p,missionName,pathToMission,missionFile = setup()
+    return p,cache,outputFolder,missionName,pathToMission
+
+#Generate an artifact with write(), unless the build cache has it up to date.
+#The canLaunchHiPOP status of the generation is kept with the artifact.
+def buildArtifact(p, cache, artifact, files, write, extraInputs = {}):
+    inputs = p.getArtifactInputs(artifact)
+    inputs.update(extraInputs)
+
+    def build():
+        canLaunchHiPOP = p.canLaunchHiPOP
+        p.canLaunchHiPOP = True
+        write()
+        info = {"canLaunchHiPOP": p.canLaunchHiPOP}
+        p.canLaunchHiPOP = canLaunchHiPOP
+        return info
+
+    info = cache.build(artifact, inputs, files, build)
+    p.canLaunchHiPOP = p.canLaunchHiPOP and info.get("canLaunchHiPOP", True)
+
+"""
+Write all the files of a mission in outputFolder, and launch HiPOP if possible and asked.
+Return the names of the HiPOP files.
+"""
+def generate(p, cache, outputFolder, missionName, pathToMission, args):
 
     ### Writing HiPOP files ###
-    hipopFolder = "hipop-files"
+    hipopFolder = os.path.join(outputFolder, "hipop-files")
     
     if not os.path.exists(hipopFolder):
         os.mkdir(hipopFolder)
     
-    logging.info("Writting HiPOP files to %s" % os.path.join(os.getcwd(), hipopFolder))
+    logging.info("Writting HiPOP files to %s" % hipopFolder)
 
     data = {}
 
     data["domainFile"] = missionName + "-domain.pddl"
-    with open(os.path.join(hipopFolder, data["domainFile"]), "w") as f:
-        f.write(p.getDomainString())
-
     data["prbFile"] = missionName + "-prb.pddl"
-    with open(os.path.join(hipopFolder, data["prbFile"]), "w") as f:
-        f.write(p.getProblemString())
-    
     data["helperFile"] = missionName + "-prb-helper.pddl"
-    with open(os.path.join(hipopFolder, data["helperFile"]), "w") as f:
-        f.write(p.getHelperString())
-    
     data["planInitFile"] = missionName + "-prb-init.plan"
-    with open(os.path.join(hipopFolder, data["planInitFile"]), "w") as f:
-        f.write(p.getPlanString())
-
     data["outputName"] = missionName
     data["planFile"] = missionName + ".plan"
 
-    with open(os.path.join(hipopFolder, "launch-example.sh"), "w") as f:
-        p.writeHiPOPLaunchFile(f, data)
+    stateFile = os.path.join(hipopFolder, missionName + "-prb-state.json")
+    seeded = args.incremental and incremental.seed(p, stateFile, os.path.join(hipopFolder, data["prbFile"]))
 
-    if p.canLaunchHiPOP:
-        logging.info("Launching HiPOP")
-        r = subprocess.call(os.path.join(hipopFolder, "launch-example.sh"))
-        if r != 0:
-            logging.error("HiPOP returned %s" % r)
-        else:
-            logging.info("Process finished correctly")
-            
+    #the file is written next to filename and moved in place once complete
+    def writeTo(filename, write):
+        def f():
+            tmpFile = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.get_ident())
             try:
-                import actionvisu
-                
-                actionvisu.drawPlanGeo(os.path.join(hipopFolder, data["outputName"] + ".pddl"), "plan-geo.png", missionFile=missionFile)
-                actionvisu.drawPlanTimeline(os.path.join(hipopFolder, data["outputName"] + ".pddl"), "plan-timeline.png")
-                actionvisu.drawPlanTimeline(os.path.join(hipopFolder, data["outputName"] + ".pddl"), "plan-timeline-move.png", onlyMove = True)
+                with open(tmpFile, "w") as out:
+                    write(out)
+                os.replace(tmpFile, filename)
+            except BaseException:
+                os.remove(tmpFile)
+                raise
+        return f
+
+    #the state is saved once the problem file is complete, with its digest
+    problemFile = os.path.join(hipopFolder, data["prbFile"])
+    def buildProblem():
+        writeTo(problemFile, lambda f: p.getProblem().write(f))()
+        incremental.saveState(p, stateFile, problemFile)
+        #a seeded problem only queries the changed points, the other cached entries are still needed
+        if not seeded:
+            p.setQueriesComplete()
+
+    for artifact,key,build in [("domain",   "domainFile",   writeTo(os.path.join(hipopFolder, data["domainFile"]), lambda f: p.getDomain().write(f))),
+                               ("problem",  "prbFile",      buildProblem),
+                               ("helper",   "helperFile",   writeTo(os.path.join(hipopFolder, data["helperFile"]), lambda f: p.getHelper().write(f))),
+                               ("planInit", "planInitFile", writeTo(os.path.join(hipopFolder, data["planInitFile"]), lambda f: f.write(p.getPlanString())))]:
+        buildArtifact(p, cache, artifact, [os.path.join(hipopFolder, data[key])], build)
+
+    launchFile = os.path.join(hipopFolder, "launch-example.sh")
+    buildArtifact(p, cache, "launch", [launchFile], writeTo(launchFile, lambda f: p.writeHiPOPLaunchFile(f, data)), {"data": data})
+
+    p.queryCache.save()
+
+    if p.canLaunchHiPOP and not args.noHiPOP:
+        planFile = os.path.join(hipopFolder, data["outputName"] + ".pddl")
+
+        def launchHiPOP():
+            logging.info("Launching HiPOP")
+            r = subprocess.call(launchFile)
+            if r != 0:
+                logging.error("HiPOP returned %s" % r)
+                return {"returned": r}
+            else:
+                logging.info("Process finished correctly")
                 
-            except ImportError:
-                logging.error("Cannot draw plans. Import actionvisu failed")
+                try:
+                    import actionvisu
+                    
+                    actionvisu.drawPlanGeo(planFile, os.path.join(outputFolder, "plan-geo.png"), missionFile=args.missionFile)
+                    actionvisu.drawPlanTimeline(planFile, os.path.join(outputFolder, "plan-timeline.png"))
+                    actionvisu.drawPlanTimeline(planFile, os.path.join(outputFolder, "plan-timeline-move.png"), onlyMove = True)
+                    
+                except ImportError:
+                    logging.error("Cannot draw plans. Import actionvisu failed")
+                return {"returned": 0}
+
+        #the plan only depends on the HiPOP files
+        planInputs = dict((a, cache.manifest[a]["digest"]) for a in ["domain", "problem", "helper", "planInit", "launch"])
+        info = cache.build("plan", planInputs, [planFile], launchHiPOP)
+        if info.get("returned", 0) != 0:
+            cache.invalidate("plan")
+            cache.save()
+
+    morseFile = os.path.join(outputFolder, "run_morse.py")
+    buildArtifact(p, cache, "morse", [morseFile], writeTo(morseFile, p.writeMorseFile))
+
+    vnetFile = os.path.join(outputFolder, "vnet_config.yaml")
+    buildArtifact(p, cache, "vnet", [vnetFile], writeTo(vnetFile, p.writeVNetFile))
+
+    buildArtifact(p, cache, "roslaunch", [os.path.join(outputFolder, f) for f in ["hidden-params.launch", "mission.launch", "stats_simu.launch"]],
+                  lambda: p.writeRoslaunchFiles(pathToMission, data, missionName, outputFolder),
+                  {"pathToMission": pathToMission, "data": data, "missionName": missionName})
+
+    cache.report()
+
+    return data
+
+#Options of the server process, that a request cannot set
+serverOptions = ["help", "serve", "compile", "logLevel"]
+
+"""
+Generation server : keeps the terrain models loaded between the missions.
+
+A client connects to the unix socket and sends one json object per line, with the path to the
+mission file in "missionFile" and optionally the options of the command line (ex: "outputFolder",
+"incremental", "noHiPOP", "jobs"), checked and converted by the parser of the command line : unknown
+options and invalid values fail the request. If "returnArtifacts" is true, the content of the generated
+HiPOP files is sent back. The server answers one json object per line, with "status" set to "ok" or "error".
+"""
+class GeneratorServer:
+    def __init__(self, address, parser):
+        self.address = address
+        self.parser = parser
+        self.terrainPool = terrain.TerrainPool()
+        self.folderLocks = {}
+        self.lock = threading.Lock()
+
+    def getFolderLock(self, folder):
+        with self.lock:
+            if folder not in self.folderLocks:
+                self.folderLocks[folder] = threading.Lock()
+            return self.folderLocks[folder]
+
+    #Command line of the options of a request, so that they are checked and converted by the parser.
+    #A null value keeps the default of the option
+    def getArgv(self, request):
+        options = dict((a.dest, a) for a in self.parser._actions if a.option_strings and a.dest not in serverOptions)
+        argv = [str(request["missionFile"])]
+        for k,v in request.items():
+            if k in ["missionFile", "returnArtifacts"] or v is None:
+                continue
+            if k not in options:
+                raise IllFormatedInput("unknown option %s" % k)
+            option = options[k].option_strings[-1]
+            if options[k].nargs == 0:
+                if not isinstance(v, bool):
+                    raise IllFormatedInput("%s expects true or false" % k)
+                if v:
+                    argv.append(option)
+            else:
+                argv.append("%s=%s" % (option, v))
+        return argv
+
+    def run(self, request):
+        if "missionFile" not in request:
+            raise IllFormatedInput("missing missionFile")
+
+        argv = self.getArgv(request)
+        try:
+            args = self.parser.parse_args(argv)
+        except SystemExit:
+            raise IllFormatedInput("invalid options %s" % " ".join(argv[1:]))
+        args.force = True
+
+        outputFolder = os.path.abspath(args.outputFolder or os.path.splitext(os.path.expandvars(os.path.abspath(args.missionFile)))[0])
+        with self.getFolderLock(outputFolder):
+            p,cache,outputFolder,missionName,pathToMission = setup(args, self.terrainPool, interactive=False)
+            data = generate(p, cache, outputFolder, missionName, pathToMission, args)
+
+        result = {"status": "ok", "outputFolder": outputFolder, "canLaunchHiPOP": p.canLaunchHiPOP,
+                  "reused": cache.reused, "rebuilt": cache.rebuilt, "files": data}
+        if request.get("returnArtifacts", False):
+            result["artifacts"] = {}
+            for key in ["domainFile", "prbFile", "helperFile", "planInitFile"]:
+                with open(os.path.join(outputFolder, "hipop-files", data[key])) as f:
+                    result["artifacts"][data[key]] = f.read()
+        return result
+
+    def serve(self):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        result = server.run(json.loads(line.decode()))
+                    except (Exception, SystemExit) as e:
+                        logging.exception("Job failed")
+                        result = {"status": "error", "message": "%s: %s" % (type(e).__name__, e)}
+                    self.wfile.write((json.dumps(result) + "\n").encode())
+                    self.wfile.flush()
+
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+        s = socketserver.ThreadingUnixStreamServer(self.address, Handler)
+        s.daemon_threads = True
+        logging.info("Waiting for missions on %s" % self.address)
+        try:
+            s.serve_forever()
+        finally:
+            s.server_close()
+            os.remove(self.address)
+
+def main():
+    parser = getParser()
+    args = parser.parse_args()
+
+    #Configure the logger
+    numeric_level = getattr(logging, args.logLevel.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % args.logLevel)
+    logging.basicConfig(level=numeric_level, format='%(levelname)s(%(filename)s:%(lineno)d):%(message)s')
+
+    if args.serve is not None:
+        GeneratorServer(args.serve, parser).serve()
+        return 0
 
-    with open("run_morse.py", "w") as f:
-        p.writeMorseFile(f)
+    if args.missionFile is None:
+        parser.error("missionFile is required")
 
-    with open("vnet_config.yaml", "w") as f:
-        p.writeVNetFile(f)
+    if args.compile:
+        try:
+            missionmodel.loadMission(os.path.expandvars(os.path.abspath(args.missionFile)))
+        except missionmodel.InvalidMission as e:
+            logging.error("Invalid mission %s :\n%s" % (args.missionFile, e))
+            return 1
+        return 0
 
-    p.writeRoslaunchFiles(pathToMission, data, missionName)
+    p,cache,outputFolder,missionName,pathToMission = setup(args)
+    generate(p, cache, outputFolder, missionName, pathToMission, args)
 
     logging.info("Done")
     
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import logging
+import os
+
+cacheVersion = 1
+
+def digest(inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+"""
+Remembers the digest of the inputs of each generated artifact, in a manifest stored in the
+output folder. An artifact is rebuilt only if its inputs changed or one of its files is missing.
+Each artifact can also keep a small dictionary of information about its last build.
+"""
+class BuildCache:
+    def __init__(self, filename):
+        self.filename = filename
+        self.manifest = {}
+        self.reused = []
+        self.rebuilt = []
+
+        if filename is not None and os.access(filename, os.R_OK):
+            try:
+                with open(filename, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == cacheVersion:
+                    self.manifest = data["artifacts"]
+            except ValueError:
+                logging.warning("Build cache %s is corrupted. Ignoring it" % filename)
+
+    def isFresh(self, artifact, inputDigest, files):
+        entry = self.manifest.get(artifact, None)
+        if entry is None or entry["digest"] != inputDigest:
+            return False
+        return all(os.path.exists(f) for f in files)
+
+    def getInfo(self, artifact):
+        return self.manifest.get(artifact, {}).get("info", {})
+
+    """
+    Call build() unless artifact is fresh. build returns a dictionary of information stored with the artifact.
+    Return the information of the artifact.
+    """
+    def build(self, artifact, inputs, files, build):
+        inputDigest = digest(inputs)
+        if self.filename is not None and self.isFresh(artifact, inputDigest, files):
+            self.reused.append(artifact)
+            return self.getInfo(artifact)
+
+        #an interrupted build must not leave the previous entry, which could match the inputs again later
+        self.invalidate(artifact)
+        self.save()
+
+        info = build() or {}
+        self.manifest[artifact] = {"digest": inputDigest, "info": info}
+        self.rebuilt.append(artifact)
+        self.save()
+        return info
+
+    def invalidate(self, artifact):
+        self.manifest.pop(artifact, None)
+
+    def save(self):
+        if self.filename is None:
+            return
+        with open(self.filename, "w") as f:
+            json.dump({"version": cacheVersion, "artifacts": self.manifest}, f)
+
+    def report(self):
+        if self.reused:
+            logging.info("Reused artifacts : %s" % " ".join(self.reused))
+        if self.rebuilt:
+            logging.info("Rebuilt artifacts : %s" % " ".join(self.rebuilt))
@@ -0,0 +1,46 @@
+import itertools
+import math
+
+"""
+Uniform grid over 2D points, used to find the points that lie within a given range
+"""
+class GridIndex:
+    def __init__(self, points, cellSize):
+        self.points = points
+        self.cellSize = float(cellSize)
+        self.cells = {}
+        for i,p in enumerate(points):
+            self.cells.setdefault(self.getCell(p), []).append(i)
+
+    def getCell(self, p):
+        return (int(math.floor(p[0] / self.cellSize)), int(math.floor(p[1] / self.cellSize)))
+
+    #return the indexes of the points within radius of p
+    def query(self, p, radius):
+        cx, cy = self.getCell(p)
+        n = int(math.ceil(radius / self.cellSize))
+        result = []
+        for dx, dy in itertools.product(range(-n, n+1), repeat=2):
+            for i in self.cells.get((cx+dx, cy+dy), []):
+                q = self.points[i]
+                if math.hypot(p[0] - q[0], p[1] - q[1]) <= radius:
+                    result.append(i)
+        return sorted(result)
+
+"""
+Yield the (i,j) worth testing, i being an index in points1 and j in points2.
+If maxRange is given, pairs further apart than maxRange (in 2D) are skipped.
+"""
+def candidatePairs(points1, points2, maxRange):
+    if maxRange is None:
+        for i,j in itertools.product(range(len(points1)), range(len(points2))):
+            yield (i,j)
+        return
+
+    if maxRange <= 0:
+        return
+
+    index = GridIndex(points2, maxRange)
+    for i,p in enumerate(points1):
+        for j in index.query(p, maxRange):
+            yield (i,j)
@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+storeVersion = 1
+
+"""
+Binary store of the distances between the waypoints of each model.
+
+The store is a folder containing index.json, which lists the points of each model, and one
+<model>.npy file per model holding the symmetric cost matrix between these points (NaN for
+unknown costs). The matrices are memory-mapped when loaded, and lookups are done by integer
+index. When points are added, only the missing entries are computed. When the store is saved,
+the points of a model that were not given to update() are removed from its matrix.
+"""
+class DistanceStore:
+    def __init__(self, folder, legacyFile = None):
+        self.folder = folder
+        self.points = {}   #key:model. Value : list of (x,y)
+        self.index = {}    #key:model. Value : dict (x,y) -> index in the matrix
+        self.matrix = {}   #key:model. Value : cost matrix
+        self.modified = set()
+        self.used = {}     #key:model. Value : set of the points given to update
+
+        indexFile = os.path.join(folder, "index.json")
+        if os.access(indexFile, os.R_OK):
+            with open(indexFile, "r") as f:
+                data = json.load(f)
+            if data.get("version") == storeVersion:
+                for model,points in data["models"].items():
+                    matrixFile = os.path.join(folder, model + ".npy")
+                    if not os.access(matrixFile, os.R_OK):
+                        logging.warning("Cannot find %s. Ignoring the distances of %s" % (matrixFile, model))
+                        continue
+                    self.setPoints(model, [tuple(p) for p in points], np.load(matrixFile, mmap_mode="r"))
+            else:
+                logging.warning("Distance store %s has an old format. Ignoring it" % folder)
+
+        if legacyFile is not None and os.access(legacyFile, os.R_OK):
+            self.importJson(legacyFile)
+
+    def setPoints(self, model, points, matrix):
+        self.points[model] = points
+        self.index[model] = dict((p, i) for i,p in enumerate(points))
+        self.matrix[model] = matrix
+
+    #Read a distance map in the former json format : {model : {"x1_y1_x2_y2" : cost}}
+    def importJson(self, filename):
+        with open(filename, "r") as f:
+            data = json.load(f)
+
+        for model,costs in data.items():
+            if model in self.points:
+                continue
+            logging.info("Importing the distances of %s from %s" % (model, filename))
+
+            pairs = []
+            for key,cost in costs.items():
+                x1, y1, x2, y2 = [float(c) for c in key.split("_")]
+                pairs.append(((x1, y1), (x2, y2), cost))
+
+            self.setPoints(model, [], np.zeros((0, 0)))
+            self.addPoints(model, [p for pair in pairs for p in pair[:2]])
+            m = self.matrix[model]
+            index = self.index[model]
+            for p1,p2,cost in pairs:
+                m[index[p1], index[p2]] = m[index[p2], index[p1]] = cost
+            self.modified.add(model)
+
+    #Add the points that are not yet in the matrix of model
+    def addPoints(self, model, points):
+        if model not in self.points:
+            self.setPoints(model, [], np.zeros((0, 0)))
+
+        newPoints = []
+        seen = set(self.index[model].keys())
+        for p in points:
+            if p not in seen:
+                seen.add(p)
+                newPoints.append(p)
+
+        if not newPoints:
+            return
+
+        old = self.matrix[model]
+        n = len(old) + len(newPoints)
+        m = np.full((n, n), np.nan)
+        m[:len(old), :len(old)] = old
+        np.fill_diagonal(m, 0)
+        self.setPoints(model, self.points[model] + newPoints, m)
+        self.modified.add(model)
+
+    def getIndex(self, model, point):
+        return self.index[model][point]
+
+    def get(self, model, i, j):
+        return self.matrix[model][i, j]
+
+    """
+    Make sure all the costs between points are known.
+    computeRows is called with a list of (i, source, targets) and yields (i, costs), i being an index
+    in the matrix. Only the sources with missing costs are given, with the missing targets only.
+    """
+    def update(self, model, points, computeRows):
+        self.used.setdefault(model, set()).update(points)
+        self.addPoints(model, points)
+
+        indexes = np.array(sorted(set(self.index[model][p] for p in points)), dtype=int)
+        missing = np.triu(np.isnan(self.matrix[model][np.ix_(indexes, indexes)]), 1)
+        if not missing.any():
+            return
+
+        logging.info("Computing %d missing distances for %s" % (missing.sum(), model))
+        if not self.matrix[model].flags.writeable:
+            self.matrix[model] = np.array(self.matrix[model])
+
+        rows = []
+        targetsOf = {}
+        for r in np.nonzero(missing.any(axis=1))[0]:
+            i = int(indexes[r])
+            targetsOf[i] = indexes[np.nonzero(missing[r])[0]]
+            rows.append((i, self.points[model][i], [self.points[model][j] for j in targetsOf[i]]))
+
+        m = self.matrix[model]
+        for i,costs in computeRows(rows):
+            m[i, targetsOf[i]] = costs
+            m[targetsOf[i], i] = costs
+        self.modified.add(model)
+
+    #Keep only the points of the models given to update(), so that the moved points do not stay in the matrices
+    def compact(self):
+        for model,used in self.used.items():
+            keep = [i for i,p in enumerate(self.points[model]) if p in used]
+            if len(keep) == len(self.points[model]):
+                continue
+            logging.info("Removing %d unused points from the distances of %s" % (len(self.points[model]) - len(keep), model))
+            self.setPoints(model, [self.points[model][i] for i in keep], np.array(self.matrix[model][np.ix_(keep, keep)]))
+            self.modified.add(model)
+
+    def save(self):
+        self.compact()
+        if not self.modified:
+            return
+
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        for model in self.modified:
+            tmpFile = os.path.join(self.folder, model + ".tmp.npy")
+            np.save(tmpFile, self.matrix[model])
+            os.replace(tmpFile, os.path.join(self.folder, model + ".npy"))
+
+        with open(os.path.join(self.folder, "index.json"), "w") as f:
+            json.dump({"version": storeVersion, "models": dict((m, [list(p) for p in pts]) for m,pts in self.points.items())}, f)
+
+        self.modified = set()
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import logging
+import os
+
+import pddl
+import querycache
+
+"""
+Incremental regeneration of the problem.
+
+After each generation, the parts of the mission the problem depends on are saved next to it.
+On the next run, the waypoints and observation points that did not move keep the visibility
+and communication results found in the previous problem file, and only the rows and columns
+of the changed points are evaluated again. The problem is then written by the usual code, so
+the output is the same as a full regeneration.
+"""
+
+def getState(p):
+    m = p.mission
+    return {"agents": dict((a, {"model": v["model"], "wp_group": v["wp_group"]}) for a,v in m["agents"].items()),
+            "models": m["models"],
+            "terrain": dict((model, [p.terrainTag] + [querycache.fileDigest(f) for f in files]) for model,files in p.terrainFiles.items()),
+            "waypoints": dict((g, v["waypoints"]) for g,v in m["wp_groups"].items()),
+            "observation_points": m["mission_goal"]["observation_points"]}
+
+def problemDigest(problemFile):
+    h = hashlib.sha1()
+    with open(problemFile, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+#The state records the digest of the problem file it describes, and the reduction used to write it.
+#The reduction is not part of getState : computing it makes all the queries seed() avoids.
+def saveState(p, filename, problemFile):
+    state = getState(p)
+    state["problem"] = problemDigest(problemFile)
+    state["reduction"] = None if p.getReduction() is None else p.getReduction().getState()
+    with open(filename, "w") as f:
+        json.dump(state, f)
+
+#keys of d1 whose value is the same in d2
+def _unchanged(d1, d2):
+    return set(k for k,v in d1.items() if k in d2 and d2[k] == v)
+
+"""
+Seed the visibility and communication results of p with the facts of the previous problem.
+Return False if the previous run cannot be used (different agents, models or terrain).
+"""
+def seed(p, stateFile, problemFile):
+    if not os.access(stateFile, os.R_OK) or not os.access(problemFile, os.R_OK):
+        logging.info("No previous problem to update. Generating it from scratch")
+        return False
+
+    with open(stateFile, "r") as f:
+        old = json.load(f)
+    new = getState(p)
+
+    if old.get("problem", None) != problemDigest(problemFile):
+        logging.info("%s does not match the saved state. Generating the problem from scratch" % problemFile)
+        return False
+
+    for key in ["agents", "models", "terrain"]:
+        if old[key] != new[key]:
+            logging.info("The %s have changed. Generating the problem from scratch" % key)
+            return False
+
+    #waypoints and observation points that did not move, with their previous names
+    wps = set()
+    for group,waypoints in new["waypoints"].items():
+        wps.update((group, index) for index in _unchanged(waypoints, old["waypoints"].get(group, {})))
+    obs = _unchanged(new["observation_points"], old["observation_points"])
+
+    #the facts of the waypoints dropped and of the observation points merged by a reduction are not in the problem
+    reduced = old.get("reduction", None) or {"waypoints": [], "observation_points": []}
+    dropped = set(tuple(wp) for wp in reduced["waypoints"])
+    obs.difference_update(reduced["observation_points"])
+
+    logging.info("Updating %s : %d/%d waypoints and %d/%d observation points unchanged" % (problemFile,
+                 len(wps), sum(len(w) for w in new["waypoints"].values()), len(obs), len(new["observation_points"])))
+
+    with open(problemFile, "r") as f:
+        prb = pddl.readProblem(f)
+
+    locOf = dict((p.getLocName(wp), wp) for wp in wps)
+    obsOf = dict((p.getObsLocName(o), o) for o in obs)
+
+    visible = set()
+    for robot,loc,o in prb.getFacts("visible"):
+        if loc in locOf and o in obsOf and robot in p.mission["agents"]:
+            wp = locOf[loc]
+            visible.add((p.getRobotModel(robot), wp[0], wp[1], obsOf[o]))
+
+    for robot in p.getRobotList():
+        model = p.getRobotModel(robot)
+        for wp in p.getLocsOfRobot(robot):
+            if wp not in wps:
+                continue
+            if (model,) + wp in dropped:
+                continue
+            for o in obs:
+                key = (model, wp[0], wp[1], o)
+                p.visibilitySeed[key] = key in visible
+
+    links = set()
+    for robot1,robot2,loc1,loc2 in prb.getFacts("visible-com"):
+        if loc1 in locOf and loc2 in locOf and robot1 in p.mission["agents"] and robot2 in p.mission["agents"]:
+            links.add(tuple(sorted([(p.getRobotModel(robot1),) + locOf[loc1], (p.getRobotModel(robot2),) + locOf[loc2]])))
+
+    robots = p.getRobotList()
+    for i,robot1 in enumerate(robots):
+        for robot2 in robots[i+1:]:
+            model1 = p.getRobotModel(robot1)
+            model2 = p.getRobotModel(robot2)
+            for wp1 in p.getLocsOfRobot(robot1):
+                if wp1 not in wps or (model1,) + wp1 in dropped:
+                    continue
+                for wp2 in p.getLocsOfRobot(robot2):
+                    if wp2 not in wps or (model2,) + wp2 in dropped:
+                        continue
+                    key = tuple(sorted([(model1,) + wp1, (model2,) + wp2]))
+                    p.comLinks[key] = key in links
+
+    return True
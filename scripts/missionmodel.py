@@ -0,0 +1,320 @@
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+"""
+Compiled mission model.
+
+The mission dictionary, once converted to numbers, is read into the classes below. Agents,
+models and waypoint groups hold the fields used by the generator, each waypoint group and the
+observation points keep their coordinates in numpy arrays, and every waypoint and observation
+point gets an integer id (its row in these arrays) and its PDDL name, computed once.
+"""
+
+snapshotVersion = 1
+
+class InvalidMission(Exception):
+    pass
+
+"""
+Robot model, with the content of its config file
+"""
+class Model:
+    __slots__ = ["name", "velocity", "antennaHeight", "antennaRange", "data"]
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.velocity = data["robot"]["velocity"]
+        self.antennaHeight = data["antenna"]["pose"]["z"]
+        antennaRange = data["antenna"].get("range", None)
+        self.antennaRange = None if antennaRange in [None, ""] else float(antennaRange)
+
+class Agent:
+    __slots__ = ["name", "model", "group", "spare", "position", "initIndex"]
+
+    def __init__(self, name, data):
+        self.name = name
+        self.model = data["model"]
+        self.group = data["wp_group"]
+        self.spare = data["spare"]
+        self.position = data["position"]
+        self.initIndex = None #index of the waypoint of the initial position
+
+"""
+Set of named points : the waypoints of a group or the observation points.
+The point of index indexes[i] has the id i, the coordinates x[i], y[i] and the name names[i].
+"""
+class PointSet:
+    __slots__ = ["indexes", "ids", "x", "y", "z", "names", "locs", "positions", "formatName", "height"]
+
+    #formatName(index, point) gives the PDDL name of a point. height is the z given to the terrain queries
+    def __init__(self, points, formatName, height):
+        self.formatName = formatName
+        self.height = height
+        self.indexes = []
+        self.ids = {}       #key:index. Value : id
+        self.names = []
+        self.locs = []      #(x, y, height) of each point
+        self.positions = {} #key:(x, y). Value : index of the first point at this position
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+        self.z = np.zeros(0) #NaN if the point has no z
+
+        self.addPoints(points)
+
+    def addPoints(self, points):
+        for index,pt in points.items():
+            self.ids[index] = len(self.indexes)
+            self.indexes.append(index)
+            self.names.append(self.formatName(index, pt))
+            self.locs.append((pt["x"], pt["y"], self.height))
+            self.positions.setdefault((pt["x"], pt["y"]), index)
+
+        self.x = np.append(self.x, [pt["x"] for pt in points.values()])
+        self.y = np.append(self.y, [pt["y"] for pt in points.values()])
+        self.z = np.append(self.z, [pt.get("z", np.nan) for pt in points.values()])
+
+    def __len__(self):
+        return len(self.indexes)
+
+class WaypointGroup(PointSet):
+    __slots__ = ["name", "patrols"]
+
+    def __init__(self, name, data):
+        self.name = name
+        self.patrols = data.get("patrols", {})
+
+        def formatName(index, pt):
+            if "z" in pt:
+                return "%s_%d_%d_%d" % (name, pt["x"]*100, pt["y"]*100, pt["z"]*100)
+            else:
+                return "%s_%d_%d" % (name, pt["x"]*100, pt["y"]*100)
+
+        PointSet.__init__(self, data["waypoints"], formatName, 40 if "ressac" in name else 0)
+
+"""
+Mission read from a mission dictionary whose values are numbers, and with the config of each
+model merged in its entry. The agents whose initial position is not a waypoint of their group
+get a new waypoint "_init_<agent>", added to the group and to the dictionary.
+"""
+class Mission:
+    __slots__ = ["agents", "models", "groups", "observations"]
+
+    def __init__(self, mission):
+        self.models = dict((name, Model(name, data)) for name,data in mission["models"].items())
+        self.agents = dict((name, Agent(name, data)) for name,data in mission["agents"].items())
+        self.groups = dict((name, WaypointGroup(name, data)) for name,data in mission["wp_groups"].items())
+        self.observations = PointSet(mission["mission_goal"]["observation_points"],
+                                     lambda index, pt: "ptobs_%d_%d" % (pt["x"]*100, pt["y"]*100), 1)
+
+        for agent in self.agents.values():
+            group = self.groups[agent.group]
+            agent.initIndex = group.positions.get((agent.position["x"], agent.position["y"]), None)
+            if agent.initIndex is None:
+                agent.initIndex = "_init_" + agent.name
+                mission["wp_groups"][agent.group]["waypoints"][agent.initIndex] = agent.position
+                group.addPoints({agent.initIndex: agent.position})
+
+    def getGroupOfAgent(self, agent):
+        return self.groups[self.agents[agent].group]
+
+    def getModelOfAgent(self, agent):
+        return self.models[self.agents[agent].model]
+
+#Schema of the parts of the mission used by the generator. A dictionary gives the schema of its
+#keys, optional keys ending with "?", and "*" gives the schema of the other keys. Other values
+#are the name of a type, or None for anything. The editor writes all the values as strings.
+_numbers = {"x": "number", "y": "number", "*": "number"}
+schema = {"home_dir": "string",
+          "map_data": {"region_file": "string", "dtm_file": "string"},
+          "models": {"*": {"config_file": "string", "region_file?": "string"}},
+          "agents": {"*": {"model": "string", "wp_group": "string", "position": _numbers, "spare?": "boolean"}},
+          "wp_groups": {"*": {"waypoints": {"*": _numbers}, "patrols?": {"*": None}}},
+          "mission_goal": {"observation_points": {"*": _numbers}, "communication_goals?": None}}
+
+def _isNumber(v):
+    try:
+        float(v)
+        return not isinstance(v, bool)
+    except (TypeError, ValueError):
+        return False
+
+_checks = {"string": lambda v: isinstance(v, str),
+           "number": _isNumber,
+           "boolean": lambda v: v in [True, False, "true", "True", "false", "False"]}
+
+def _check(value, s, path, errors):
+    if s is None:
+        return
+    if not isinstance(s, dict):
+        if not _checks[s](value):
+            errors.append("%s : expected a %s, found %r" % (path, s, value))
+        return
+    if not isinstance(value, dict):
+        errors.append("%s : expected an object" % path)
+        return
+    for key,sub in s.items():
+        if key == "*":
+            continue
+        name = key.rstrip("?")
+        if name in value:
+            _check(value[name], sub, path + "/" + name, errors)
+        elif not key.endswith("?"):
+            errors.append("%s : missing %s" % (path, name))
+    if "*" in s:
+        for key,v in value.items():
+            if key not in s and key + "?" not in s:
+                _check(v, s["*"], path + "/" + key, errors)
+
+#Raise InvalidMission if the mission does not follow the schema or refers to unknown models, groups or waypoints
+def validate(mission):
+    errors = []
+    _check(mission, schema, "", errors)
+    if not errors:
+        for name,agent in mission["agents"].items():
+            if agent["model"] not in mission["models"]:
+                errors.append("/agents/%s : unknown model %s" % (name, agent["model"]))
+            if agent["wp_group"] not in mission["wp_groups"]:
+                errors.append("/agents/%s : unknown waypoint group %s" % (name, agent["wp_group"]))
+        for name,group in mission["wp_groups"].items():
+            for patrol,points in group.get("patrols", {}).items():
+                for pt in points:
+                    if pt not in group["waypoints"]:
+                        errors.append("/wp_groups/%s/patrols/%s : unknown waypoint %s" % (name, patrol, pt))
+    if errors:
+        raise InvalidMission("\n".join(errors))
+
+#Convert the values written as strings by the editor to numbers and booleans
+def normalize(mission):
+    for agent in mission["agents"].values():
+        agent["spare"] = agent.get("spare", False) in [True, "true", "True"]
+        for k,v in agent["position"].items():
+            agent["position"][k] = float(v)
+
+    for group in mission["wp_groups"].values():
+        for pt in group["waypoints"].values():
+            for k,v in pt.items():
+                pt[k] = float(v)
+
+    for pt in mission["mission_goal"]["observation_points"].values():
+        for k,v in pt.items():
+            pt[k] = float(v)
+    if mission["mission_goal"].get("communication_goals", "") == "":
+        mission["mission_goal"]["communication_goals"] = {} #Boost::property_tree replace {} with ""
+
+"""
+Validate and normalize the mission, and merge the config file of each model in its entry.
+home_dir must already be expanded. Return the list of the config files read.
+"""
+def compileMission(mission):
+    validate(mission)
+    normalize(mission)
+
+    configFiles = []
+    for name,model in mission["models"].items():
+        configFile = os.path.join(mission["home_dir"], model["config_file"])
+        if not os.access(configFile, os.R_OK):
+            raise InvalidMission("Cannot open %s" % configFile)
+        with open(configFile) as f:
+            model.update(json.load(f))
+        configFiles.append(configFile)
+    return configFiles
+
+def _fileState(filename):
+    st = os.stat(filename)
+    return [filename, st.st_size, st.st_mtime_ns]
+
+#The point sets of the mission, by name in the snapshot
+def _getPointSets(mission):
+    sets = dict(("wp:" + name, group["waypoints"]) for name,group in mission["wp_groups"].items())
+    sets["obs"] = mission["mission_goal"]["observation_points"]
+    return sets
+
+"""
+Save a compiled mission in filename (.npz). The point sets are stored as arrays, one per field
+(NaN if a point does not have it), and the rest of the mission as a json header, with the state
+of the files the mission was compiled from.
+"""
+def saveSnapshot(mission, dependencies, filename):
+    pointSets = _getPointSets(mission)
+    header = dict((k, v) for k,v in mission.items() if k not in ["wp_groups", "mission_goal"])
+    header["wp_groups"] = dict((name, dict((k, v) for k,v in group.items() if k != "waypoints")) for name,group in mission["wp_groups"].items())
+    header["mission_goal"] = dict((k, v) for k,v in mission["mission_goal"].items() if k != "observation_points")
+
+    arrays = {}
+    fields = {}
+    for name,points in pointSets.items():
+        fields[name] = sorted(set(k for pt in points.values() for k in pt.keys()))
+        arrays[name + ":indexes"] = np.array(list(points.keys()), dtype=str)
+        for field in fields[name]:
+            arrays[name + ":" + field] = np.array([pt.get(field, np.nan) for pt in points.values()], dtype=float)
+
+    data = {"version": snapshotVersion, "dependencies": [_fileState(f) for f in dependencies], "fields": fields, "mission": header}
+    arrays["header"] = np.array(json.dumps(data))
+
+    tmpFile = filename + ".%d.%d.tmp.npz" % (os.getpid(), threading.get_ident())
+    np.savez(tmpFile, **arrays)
+    os.replace(tmpFile, filename)
+
+#Load a compiled mission saved by saveSnapshot. Return None if it is outdated
+def loadSnapshot(filename):
+    with np.load(filename) as arrays:
+        data = json.loads(str(arrays["header"]))
+        if data["version"] != snapshotVersion:
+            return None
+        for dependency in data["dependencies"]:
+            if not os.path.exists(dependency[0]) or _fileState(dependency[0]) != dependency:
+                return None
+
+        mission = data["mission"]
+        pointSets = {}
+        for name,fields in data["fields"].items():
+            columns = [arrays[name + ":" + field].tolist() for field in fields]
+            points = {}
+            for index,values in zip(arrays[name + ":indexes"].tolist(), zip(*columns)):
+                points[index] = dict((f, v) for f,v in zip(fields, values) if v == v) #NaN : missing field
+            pointSets[name] = points
+
+    for name,group in mission["wp_groups"].items():
+        group["waypoints"] = pointSets["wp:" + name]
+    mission["mission_goal"]["observation_points"] = pointSets["obs"]
+    return mission
+
+"""
+Read a mission file, validated and normalized. The compiled mission is saved in a snapshot next
+to the mission file (<mission>.snapshot.npz), which is loaded instead of the mission file as long
+as it is newer than the mission file and the config files of the models did not change.
+"""
+def loadMission(missionFile, useSnapshot = True):
+    snapshotFile = os.path.splitext(missionFile)[0] + ".snapshot.npz"
+    if useSnapshot and os.access(snapshotFile, os.R_OK) and os.path.getmtime(snapshotFile) >= os.path.getmtime(missionFile):
+        try:
+            mission = loadSnapshot(snapshotFile)
+        except (ValueError, KeyError, IOError) as e:
+            logging.warning("Cannot read the mission snapshot %s : %s" % (snapshotFile, e))
+            mission = None
+        if mission is not None and mission["home_dir"] == os.path.expandvars(mission["source_home_dir"]):
+            logging.info("Using mission snapshot : %s" % snapshotFile)
+            del mission["source_home_dir"]
+            return mission
+
+    with open(missionFile) as f:
+        mission = json.load(f)
+
+    sourceHomeDir = mission.get("home_dir", None)
+    if isinstance(sourceHomeDir, str):
+        mission["home_dir"] = os.path.expandvars(sourceHomeDir)
+    configFiles = compileMission(mission)
+
+    if useSnapshot:
+        mission["source_home_dir"] = sourceHomeDir #the snapshot is outdated if the environment changes home_dir
+        try:
+            saveSnapshot(mission, [missionFile] + configFiles, snapshotFile)
+        except (IOError, OSError) as e:
+            logging.warning("Cannot write the mission snapshot %s : %s" % (snapshotFile, e))
+        del mission["source_home_dir"]
+    return mission
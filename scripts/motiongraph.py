@@ -0,0 +1,78 @@
+import numpy as np
+
+try:
+    from scipy.sparse.csgraph import shortest_path
+except ImportError:
+    shortest_path = None
+
+"""
+Sparse motion graph between the waypoints of a robot.
+
+The costs are replaced by the costs of the shortest paths, which satisfy the triangle inequality,
+and an edge is kept only if no path through another waypoint is as short : the shortest paths of
+the remaining graph have the same costs as in the complete one. With a number of neighbours, each
+waypoint only keeps the edges to its nearest neighbours, plus the edges of a minimum spanning tree
+so that the waypoints that were connected stay connected.
+"""
+
+#Costs of the shortest paths through the edges of the boolean matrix valid
+def shortestPaths(costs, valid):
+    weights = np.where(valid, costs, np.inf)
+    np.fill_diagonal(weights, 0)
+    if shortest_path is not None:
+        return shortest_path(weights, method="D")
+
+    #Floyd-Warshall, used when scipy is not installed
+    for k in range(len(weights)):
+        np.minimum(weights, weights[:,k,np.newaxis] + weights[np.newaxis,k,:], out=weights)
+    return weights
+
+#Boolean matrix of the edges i,j such that every path through another waypoint is longer
+def undominatedEdges(dist, valid):
+    n = len(dist)
+    through = np.full((n, n), np.inf) #cost of the shortest path through another waypoint
+    d = np.empty((n, n))
+    for k in range(n):
+        np.add(dist[:,k,np.newaxis], dist[np.newaxis,k,:], out=d)
+        d[k,:] = np.inf
+        d[:,k] = np.inf
+        np.minimum(through, d, out=through)
+    return valid & (dist < through)
+
+#Symmetric boolean matrix of the edges of a minimum spanning forest of the graph (np.inf for no edge)
+def spanningForest(weights):
+    n = len(weights)
+    edges = np.zeros((n, n), dtype=bool)
+    inTree = np.zeros(n, dtype=bool)
+    best = np.full(n, np.inf) #cost of the cheapest edge joining each point to the tree
+    parent = np.full(n, -1)
+    for _ in range(n):
+        candidates = np.where(inTree, np.inf, best)
+        i = int(np.argmin(candidates))
+        if np.isinf(candidates[i]):
+            i = int(np.argmin(inTree)) #starts a new tree
+        elif parent[i] >= 0:
+            edges[i, parent[i]] = edges[parent[i], i] = True
+        inTree[i] = True
+        closer = ~inTree & (weights[i] < best)
+        best[closer] = weights[i][closer]
+        parent[closer] = i
+    return edges
+
+"""
+Edges of the sparse motion graph of a symmetric cost matrix. valid tells the edges of the complete graph.
+Return the costs of the shortest paths and the boolean matrix of the kept edges.
+"""
+def sparseGraph(costs, valid, neighbours = None):
+    dist = shortestPaths(costs, valid)
+    edges = undominatedEdges(dist, valid)
+
+    if neighbours is not None:
+        weights = np.where(edges, dist, np.inf)
+        nearest = np.argsort(weights, axis=1)[:, :neighbours]
+        kept = np.zeros_like(edges)
+        kept[np.arange(len(edges))[:,np.newaxis], nearest] = True
+        kept &= edges
+        edges = kept | kept.T | spanningForest(weights)
+
+    return dist, edges
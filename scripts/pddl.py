@@ -1,5 +1,12 @@
+from array import array
+import io
 import re
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Domain:
     def __init__(self, name):
         self.name = name
@@ -36,23 +43,18 @@ class Domain:
         self.actions.append(a)
         
     def toString(self):
-        result = """
-(define (domain {name})
-  (:requirements {reqList})
-  (:types {typeList})
-  (:predicates {predList})
-  (:functions {funcList})
+        f = io.StringIO()
+        self.write(f)
+        return f.getvalue()
 
-  {actionList}
-)
-""".format(name = self.name,
-           reqList = " ".join(self.requirements),
-           typeList = "\n    ".join([t[0] + " - " + t[1] for t in self.types]),
-           predList = "\n    ".join(["(" + p + ")" for p in self.predicates]),
-           funcList = "\n    ".join(["(" + f + ")" for f in self.functions]),
-           actionList = "\n".join([a.toString() for a in self.actions]))
-           
-        return result
+    def write(self, f):
+        f.write("\n(define (domain %s)\n" % self.name)
+        f.write("  (:requirements %s)\n" % " ".join(self.requirements))
+        f.write("  (:types %s)\n" % "\n    ".join([t[0] + " - " + t[1] for t in self.types]))
+        f.write("  (:predicates %s)\n" % "\n    ".join(["(" + p + ")" for p in self.predicates]))
+        f.write("  (:functions %s)\n\n  " % "\n    ".join(["(" + fn + ")" for fn in self.functions]))
+        _writeJoined(f, "\n", self.actions)
+        f.write("\n)\n")
 
 class Action:
     def __init__(self, name, isDurative = False):
@@ -172,6 +174,9 @@ class Action:
             
         self.methods.append(method)
 
+    def write(self, f):
+        f.write(self.toString())
+
     def toString(self):
 
         conflictList = ""
@@ -231,6 +236,9 @@ class Method:
     def addTemporalLink(self, start, end):
         self.temporalLinks.append( (start, end) )
         
+    def write(self, f):
+        f.write(self.toString())
+
     def toString(self):
         result = """
       :method {name}
@@ -275,28 +283,143 @@ class Helper:
         self.actions.append(action)
         
     def toString(self):
-        result = """
-(define (domain-helper {name})
-    (:options {optionList})
-    (:allowed-actions {allowedActionList})
-    (:low-priority-predicates {lowPriorityList})
+        f = io.StringIO()
+        self.write(f)
+        return f.getvalue()
 
-    {actionList}
-)
-""".format(name = self.domainName,
-            optionList = " ".join(self.options),
-            allowedActionList = " ".join(self.allowedActions),
-            lowPriorityList = " ".join(self.lowPriorityPredicates),
-            actionList="\n".join([a.toString() for a in self.actions]))
+    def write(self, f):
+        f.write("\n(define (domain-helper %s)\n" % self.domainName)
+        f.write("    (:options %s)\n" % " ".join(self.options))
+        f.write("    (:allowed-actions %s)\n" % " ".join(self.allowedActions))
+        f.write("    (:low-priority-predicates %s)\n\n    " % " ".join(self.lowPriorityPredicates))
+        _writeJoined(f, "\n", self.actions)
+        f.write("\n)\n")
 
-        return result
+"""
+Interns symbols (predicate, function and object names) to integer ids
+"""
+class SymbolTable:
+    __slots__ = ("names", "ids")
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+
+    def intern(self, name):
+        i = self.ids.get(name, None)
+        if i is None:
+            i = len(self.names)
+            self.ids[name] = i
+            self.names.append(name)
+        return i
+
+    def getName(self, i):
+        return self.names[i]
+
+    def __len__(self):
+        return len(self.names)
+
+"""
+Facts of a predicate or a function, stored as rows of symbol ids in a flat array.
+A function fact also has a value. Facts are deduplicated on insertion, on their arguments.
+"""
+class FactTable:
+    __slots__ = ("name", "arity", "isFunction", "args", "values", "keys")
+
+    def __init__(self, name, arity, isFunction = False):
+        self.name = name
+        self.arity = arity
+        self.isFunction = isFunction
+        self.args = array("l")
+        self.values = array("d")
+        self.keys = set()
+
+    #return False if the fact was already there
+    def add(self, ids, value = None):
+        key = self._pack(ids)
+        if key in self.keys:
+            return False
+
+        self.keys.add(key)
+        self.args.extend(ids)
+        if self.isFunction:
+            self.values.append(value)
+        return True
+
+    #columns is a list of arity sequences of symbol ids, values a sequence of the same length (functions only)
+    def addBulk(self, columns, values = None):
+        if numpy is not None and self.arity > 0:
+            columns = [numpy.asarray(c, dtype=numpy.int64) for c in columns]
+            if self.arity <= 2:
+                #pack the keys in one vectorized operation, then filter the duplicates
+                packed = columns[0] if self.arity == 1 else (columns[0] << 32) | columns[1]
+                keys = packed.tolist()
+            else:
+                keys = [self._pack(row) for row in zip(*[c.tolist() for c in columns])]
+            rows = numpy.stack(columns, axis=1).tolist()
+            if values is not None:
+                values = numpy.asarray(values, dtype=float).tolist()
+        else:
+            rows = [list(r) for r in zip(*columns)]
+            keys = [self._pack(r) for r in rows]
+
+        count = 0
+        for k,key in enumerate(keys):
+            if key in self.keys:
+                continue
+            self.keys.add(key)
+            self.args.extend(rows[k])
+            if self.isFunction:
+                self.values.append(values[k])
+            count += 1
+        return count
+
+    @staticmethod
+    def _pack(ids):
+        key = 0
+        for i in ids:
+            key = (key << 32) | i
+        return key
+
+    def __len__(self):
+        return len(self.keys)
+
+    #yield the rows of symbol ids (and the value for functions)
+    def rows(self):
+        n = self.arity
+        for k in range(len(self)):
+            ids = tuple(self.args[k*n:(k+1)*n])
+            if self.isFunction:
+                yield ids, self.values[k]
+            else:
+                yield ids
+
+    #yield the literals, as text
+    def render(self, symbols):
+        name = symbols.getName(self.name)
+        names = symbols.names
+        n = self.arity
+        for k in range(len(self)):
+            args = " ".join([names[i] for i in self.args[k*n:(k+1)*n]])
+            if self.isFunction:
+                yield "= (%s %s) %r" % (name, args, self.values[k])
+            elif args:
+                yield "%s %s" % (name, args)
+            else:
+                yield name
+
+_symbolRegex = re.compile(r"^[^\s()]+$")
+_funcRegex = re.compile(r"^=\s*\(([^()]+)\)\s*([^\s()]+)$")
 
 class Problem:
     def __init__(self, name, domain):
         self.name = name
         self.domainName = domain
-        self.objects = {}
-        self.init = []
+        self.symbols = SymbolTable()
+        self.objects = {}     #key:type. Value : list of object ids
+        self.objectSet = set()
+        self.facts = {}       #key:(symbol id, arity, isFunction). Value : FactTable
+        self.init = []        #FactTable, raw literals and generators, in insertion order
         self.goal = []
         
     def addObjects(self, type, *arg):
@@ -304,19 +427,99 @@ class Problem:
             self.addObject(o, type)
         
     def addObject(self, obj, type):
+        i = self.symbols.intern(obj)
+        if (type, i) in self.objectSet:
+            return
+        self.objectSet.add((type, i))
+
         if type not in self.objects:
             self.objects[type] = []
-        self.objects[type].append(obj)
+        self.objects[type].append(i)
+
+    def getFactTable(self, name, arity, isFunction = False):
+        key = (self.symbols.intern(name), arity, isFunction)
+        table = self.facts.get(key, None)
+        if table is None:
+            table = FactTable(key[0], arity, isFunction)
+            self.facts[key] = table
+            self.init.append(table)
+        return table
         
     def addInits(self, *arg):
         for i in arg:
             self.addInit(i)
         
+    #Literals made of symbols only (ex: "at-r r1 wp1") and functions (ex: "= (distance wp1 wp2) 2.5")
+    #are interned. Other literals are kept as they are.
     def addInit(self, literal):
+        tokens = literal.split()
+        if tokens and all(_symbolRegex.match(t) for t in tokens) and tokens[0] not in ["not", "="]:
+            self.addFact(tokens[0], tokens[1:])
+            return
+
+        m = _funcRegex.match(literal.strip())
+        if m:
+            try:
+                value = float(m.group(2))
+            except ValueError:
+                value = None
+            if value is not None:
+                tokens = m.group(1).split()
+                self.addFuncFact(tokens[0], tokens[1:], value)
+                return
+
         self.init.append(literal)
+
+    def addFact(self, predicate, args):
+        table = self.getFactTable(predicate, len(args))
+        return table.add([self.symbols.intern(a) for a in args])
+
+    def addFuncFact(self, function, args, value):
+        table = self.getFactTable(function, len(args), True)
+        return table.add([self.symbols.intern(a) for a in args], value)
+
+    #Return the ids of names, interning them if needed
+    def intern(self, names):
+        return [self.symbols.intern(n) for n in names]
+
+    """
+    Register many facts of the same predicate (or function if values is given) in one call.
+    args is a list of sequences (one per argument) of symbol ids, as returned by intern,
+    values a sequence of numbers of the same length.
+    Return the number of facts actually added (duplicates are ignored).
+    """
+    def addFactsBulk(self, name, args, values = None):
+        table = self.getFactTable(name, len(args), values is not None)
+        return table.addBulk(args, values)
+
+    #yield the arguments (as names) of the interned facts of predicate name
+    def getFacts(self, name):
+        names = self.symbols.names
+        for (symbol, arity, isFunction),table in self.facts.items():
+            if isFunction or names[symbol] != name:
+                continue
+            for ids in table.rows():
+                yield tuple([names[i] for i in ids])
+
+    #gen is an iterable of literals, only consumed when the problem is written (thus only once).
+    #They are neither interned nor deduplicated.
+    def addInitGenerator(self, gen):
+        self.init.append(gen)
+
+    def getInits(self):
+        for i in self.init:
+            if isinstance(i, str):
+                yield i
+            elif isinstance(i, FactTable):
+                for l in i.render(self.symbols):
+                    yield l
+            else:
+                for l in i:
+                    yield l
         
     def addInitFunc(self, literal, value):
-        self.init.append("= (" + literal + ") " + str(value)) 
+        tokens = literal.split()
+        self.addFuncFact(tokens[0], tokens[1:], float(value))
         
     def addGoals(self, *arg):
         for g in arg:
@@ -326,24 +529,333 @@ class Problem:
         self.goal.append(literal)
     
     def toString(self):
-    
-        objectList = "\n       ".join([" ".join(self.objects[k]) + " - " + str(k) for k in self.objects.keys()])
-    
-        result = """
-(define (problem {name})
-    (:domain {domainName})
-    (:objects {objectList})
-    (:init {initList})
-    (:goal (and {goalList}))
-)
-""".format(name = self.name, 
-        domainName = self.domainName, 
-        objectList=objectList,
-        initList="\n      ".join(["(" + l + ")" for l in self.init]),
-        goalList="\n      ".join(["(" + l + ")" for l in self.goal]))
+        f = io.StringIO()
+        self.write(f)
+        return f.getvalue()
+
+    def write(self, f):
+        f.write("\n(define (problem %s)\n" % self.name)
+        f.write("    (:domain %s)\n" % self.domainName)
+        f.write("    (:objects %s)\n" % "\n       ".join([" ".join([self.symbols.getName(o) for o in self.objects[k]]) + " - " + str(k) for k in self.objects.keys()]))
+        f.write("    (:init ")
+        _writeJoined(f, "\n      ", ("(" + l + ")" for l in self.getInits()))
+        f.write(")\n")
+        f.write("    (:goal (and %s))\n" % "\n      ".join(["(" + l + ")" for l in self.goal]))
+        f.write(")\n")
+
+#write the elements of l (strings or objects with a write method) separated by sep
+def _writeJoined(f, sep, l):
+    first = True
+    for e in l:
+        if not first:
+            f.write(sep)
+        first = False
+        if isinstance(e, str):
+            f.write(e)
+        else:
+            e.write(f)
+
+################     Reader     ################
+
+class ParseError(Exception):
+    pass
+
+_tokenRegex = re.compile(r"[()]|[^\s()]+")
+
+#yield the tokens of f ("(", ")" and atoms), one line at a time. Comments are skipped
+def tokenize(f):
+    for line in f:
+        i = line.find(";")
+        if i >= 0:
+            line = line[:i]
+        for t in _tokenRegex.findall(line):
+            yield t
+
+class _Tokens:
+    def __init__(self, f):
+        self.tokens = tokenize(f)
+        self.next = None
+        self.advance()
+
+    def advance(self):
+        current = self.next
+        self.next = next(self.tokens, None)
+        return current
+
+    def expect(self, token):
+        t = self.advance()
+        if t != token:
+            raise ParseError("Expecting %s, got %s" % (token, t))
+        return t
+
+    def atom(self):
+        t = self.advance()
+        if t is None or t in "()":
+            raise ParseError("Expecting an atom, got %s" % t)
+        return t
+
+    #read one expression : an atom, or a nested list of atoms
+    def expr(self):
+        t = self.advance()
+        if t is None:
+            raise ParseError("Unexpected end of file")
+        if t == ")":
+            raise ParseError("Unexpected )")
+        if t != "(":
+            return t
 
+        stack = [[]]
+        while stack:
+            t = self.advance()
+            if t is None:
+                raise ParseError("Unexpected end of file")
+            if t == "(":
+                stack.append([])
+            elif t == ")":
+                e = stack.pop()
+                if not stack:
+                    return e
+                stack[-1].append(e)
+            else:
+                stack[-1].append(t)
+
+    #read the expressions until the closing parenthesis of the current list (consumed)
+    def exprsUntilClose(self):
+        result = []
+        while self.next != ")":
+            result.append(self.expr())
+        self.advance()
         return result
 
+def _toString(e):
+    if isinstance(e, list):
+        return "(" + " ".join([_toString(c) for c in e]) + ")"
+    return e
+
+def _isKeyword(e):
+    return not isinstance(e, list) and e.startswith(":")
+
+#split a list of expressions [":a", x, y, ":b", z] into [(":a", [x, y]), (":b", [z])]
+def _sections(l):
+    result = []
+    for e in l:
+        if _isKeyword(e):
+            result.append((e, []))
+        elif result:
+            result[-1][1].append(e)
+        else:
+            raise ParseError("Expecting a keyword, got %s" % _toString(e))
+    return result
+
+#"?a ?b - t ?c - u" -> [("?a ?b", "t"), ("?c", "u")]
+def _typedList(l):
+    result = []
+    names = []
+    i = 0
+    while i < len(l):
+        if l[i] == "-":
+            result.append((" ".join(names), l[i+1]))
+            names = []
+            i += 2
+        else:
+            names.append(l[i])
+            i += 1
+    if names:
+        result.append((" ".join(names), "object"))
+    return result
+
+#(and a b) -> ["a", "b"], as written by Action
+def _conjunction(l):
+    if not l or l[0] == []:
+        return []
+    e = l[0]
+    if e and e[0] == "and":
+        return [_toString(c) for c in e[1:]]
+    return [_toString(e)]
+
+def _readAction(e):
+    if e[0] not in [":action", ":durative-action"]:
+        raise ParseError("Expecting an action, got %s" % e[0])
+
+    a = Action(e[1], e[0] == ":durative-action")
+    for key,values in _sections(e[2:]):
+        if key == ":parameters":
+            for param,type in _typedList(values[0]):
+                a.parameters.append((type, param))
+        elif key == ":agent":
+            a.agent = " ".join(values[0])
+        elif key == ":conflict-with":
+            a.conflicts.extend([_toString(c)[1:-1] for c in values])
+        elif key == ":duration":
+            a.duration = _toString(values[0][2])
+        elif key in [":condition", ":precondition"]:
+            a.prec.extend(_conjunction(values))
+        elif key == ":effect":
+            a.eff.extend(_conjunction(values))
+        elif key == ":side-effect":
+            a.sideEff.extend(_conjunction(values))
+        elif key == ":methods":
+            for m in values:
+                a.methods.extend(_readMethods(m))
+        else:
+            raise ParseError("Unknown action section %s in %s" % (key, a.name))
+    return a
+
+def _readMethods(l):
+    result = []
+    for key,values in _sections(l):
+        if key == ":method":
+            m = Method(values[0])
+            result.append(m)
+        elif key == ":actions":
+            m.actions.extend([(a[0], _toString(a[1])[1:-1]) for a in values])
+        elif key == ":duration":
+            m.duration = _toString(values[0][2])
+        elif key == ":precondition":
+            m.preconditions.extend([_toString(p) for p in values])
+        elif key == ":causal-links":
+            m.causalLinks.extend([(c[0], c[1], _toString(c[2])[1:-1]) for c in values])
+        elif key == ":temporal-links":
+            m.temporalLinks.extend([(c[0], c[1]) for c in values])
+        else:
+            raise ParseError("Unknown method section %s" % key)
+    return result
+
+def _readDomain(tokens, name):
+    d = Domain(name)
+    while tokens.next == "(":
+        e = tokens.expr()
+        key = e[0]
+        if key == ":requirements":
+            d.requirements.extend(e[1:])
+        elif key == ":types":
+            d.types.extend(_typedList(e[1:]))
+        elif key == ":predicates":
+            d.predicates.extend([_toString(p)[1:-1] for p in e[1:]])
+        elif key == ":functions":
+            d.functions.extend([_toString(p)[1:-1] for p in e[1:]])
+        else:
+            d.actions.append(_readAction(e))
+    tokens.expect(")")
+    return d
+
+def _readHelper(tokens, name):
+    h = Helper(name)
+    while tokens.next == "(":
+        e = tokens.expr()
+        key = e[0]
+        if key == ":options":
+            h.options.extend(e[1:])
+        elif key == ":allowed-actions":
+            h.allowedActions.extend(e[1:])
+        elif key == ":low-priority-predicates":
+            h.lowPriorityPredicates.extend(e[1:])
+        else:
+            h.actions.append(_readAction(e))
+    tokens.expect(")")
+    return h
+
+def _addInitExpr(p, e):
+    if isinstance(e, list) and e and all(not isinstance(c, list) for c in e) and e[0] not in ["not", "="]:
+        p.addFact(e[0], e[1:])
+        return
+
+    if isinstance(e, list) and len(e) == 3 and e[0] == "=" and isinstance(e[1], list) and e[1] \
+            and all(not isinstance(c, list) for c in e[1]) and not isinstance(e[2], list):
+        try:
+            p.addFuncFact(e[1][0], e[1][1:], float(e[2]))
+            return
+        except ValueError:
+            pass
+
+    p.init.append(_toString(e)[1:-1])
+
+#the init section is read literal by literal, without building its whole tree
+def _readProblem(tokens, name):
+    p = None
+    domainName = None
+    while tokens.next == "(":
+        tokens.advance()
+        key = tokens.atom()
+        if key == ":domain":
+            domainName = tokens.atom()
+            tokens.expect(")")
+            p = Problem(name, domainName)
+            continue
+
+        if p is None:
+            raise ParseError("Expecting :domain before %s in problem %s" % (key, name))
+
+        if key == ":objects":
+            for objects,type in _typedList(tokens.exprsUntilClose()):
+                p.addObjects(type, *objects.split())
+        elif key == ":init":
+            while tokens.next != ")":
+                _addInitExpr(p, tokens.expr())
+            tokens.advance()
+        elif key == ":goal":
+            p.goal.extend([g[1:-1] for g in _conjunction(tokens.exprsUntilClose())])
+        else:
+            raise ParseError("Unknown problem section %s in %s" % (key, name))
+    tokens.expect(")")
+    return p
+
+"""
+Read a domain, a problem or a helper from the file object f, in a single pass over its tokens.
+Return a Domain, a Problem or a Helper.
+"""
+def read(f):
+    tokens = _Tokens(f)
+    tokens.expect("(")
+    if tokens.atom() != "define":
+        raise ParseError("Expecting define")
+
+    tokens.expect("(")
+    kind = tokens.atom()
+    name = tokens.atom()
+    tokens.expect(")")
+
+    if kind == "domain":
+        return _readDomain(tokens, name)
+    elif kind == "problem":
+        return _readProblem(tokens, name)
+    elif kind == "domain-helper":
+        return _readHelper(tokens, name)
+    else:
+        raise ParseError("Unknown definition : %s" % kind)
+
+def load(filename):
+    with open(filename, "r") as f:
+        return read(f)
+
+def _readKind(f, cls):
+    result = read(f)
+    if not isinstance(result, cls):
+        raise ParseError("Expecting a %s, got a %s" % (cls.__name__, type(result).__name__))
+    return result
+
+def readDomain(f):
+    return _readKind(f, Domain)
+
+def readProblem(f):
+    return _readKind(f, Problem)
+
+def readHelper(f):
+    return _readKind(f, Helper)
+
+_planRegex = re.compile(r"^\s*(\d*(?:\.\d*)?)\s*:\s*\((.*)\)\s*\[(\d*(?:\.\d*)?)\]")
+
+#Read a plan as written by HiPOP ("start: (action) [duration]" lines). Return a list of (start, action, duration)
+def readPlan(f):
+    result = []
+    for line in f:
+        if line.startswith(";"):
+            continue
+        m = _planRegex.match(line)
+        if m:
+            result.append((float(m.group(1)), m.group(2), float(m.group(3))))
+    return result
+
 def main():
     a = Action("move")
     a.addParameter("toto", "tata")
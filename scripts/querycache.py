@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import os
+
+cacheVersion = 1
+
+_digests = {} #key:(path, size, mtime). Value : sha1 of the content
+
+def fileDigest(path):
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_size, st.st_mtime)
+    if key not in _digests:
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+"""
+Persistent cache of the terrain queries (is_visible, can_communicate).
+
+The cache is content-addressed : each model defines a context, which is the digest of
+the DTM, the region file, the model config and the terrain backend. Inside a context, a query is identified
+by its type, the coordinates of both endpoints and the antenna height.
+Contexts that are not used during a run are dropped when the cache is saved, so entries
+computed with an old DTM, region or config are invalidated automatically. When the caller tells
+that the run made every query of a type in a context (setComplete), the entries of that type that
+were not queried are dropped too, so the pairs of moved or deleted waypoints do not stay in the cache.
+"""
+class QueryCache:
+    def __init__(self, filename):
+        self.filename = filename
+        self.contexts = {}
+        self.queried = {} #key:context used during the run. Value : set of the keys queried in it
+        self.complete = set() #(context, type) whose queries were all made during the run
+        self.modified = False
+        self.hits = 0
+        self.misses = 0
+
+        if filename is not None and os.access(filename, os.R_OK):
+            try:
+                with open(filename, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == cacheVersion:
+                    self.contexts = data["contexts"]
+                else:
+                    logging.warning("Query cache %s has an old format. Ignoring it" % filename)
+            except ValueError:
+                logging.warning("Query cache %s is corrupted. Ignoring it" % filename)
+
+    #tag distinguishes the queries answered by different terrain backends
+    def getContext(self, *files, tag = None):
+        h = hashlib.sha1()
+        if tag is not None:
+            h.update(tag.encode())
+        for f in files:
+            h.update(fileDigest(f).encode())
+        context = h.hexdigest()
+
+        self.queried.setdefault(context, set())
+        if context not in self.contexts:
+            self.contexts[context] = {}
+        return context
+
+    def get(self, context, key):
+        self.queried[context].add(key)
+        value = self.contexts[context].get(key, None)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, context, key, value):
+        self.contexts[context][key] = value
+        self.modified = True
+
+    #The run made every query of type kind that is needed in context
+    def setComplete(self, context, kind):
+        self.complete.add((context, kind))
+
+    def save(self):
+        if self.filename is None:
+            return
+
+        logging.info("Query cache : %d hits, %d misses" % (self.hits, self.misses))
+
+        stale = [c for c in self.contexts.keys() if c not in self.queried]
+        for c in stale:
+            logging.info("Dropping %d outdated entries from the query cache" % len(self.contexts[c]))
+            del self.contexts[c]
+
+        unused = 0
+        for c,entries in self.contexts.items():
+            keys = [k for k in entries.keys() if k not in self.queried[c] and (c, k.split("|", 1)[0]) in self.complete]
+            for k in keys:
+                del entries[k]
+            unused += len(keys)
+        if unused:
+            logging.info("Dropping %d unused entries from the query cache" % unused)
+
+        if not self.modified and not stale and not unused:
+            return
+
+        with open(self.filename, "w") as f:
+            json.dump({"version": cacheVersion, "contexts": self.contexts}, f)
+        self.modified = False
+
+def _formatPoint(p):
+    return ",".join(repr(float(c)) for c in p)
+
+"""
+Wraps a terrain and serves is_visible and can_communicate (and their batch versions) from a
+QueryCache. Other methods are forwarded to the terrain.
+"""
+class CachedTerrain:
+    def __init__(self, terrain, cache, context, antennaHeight):
+        self.terrain = terrain
+        self.cache = cache
+        self.context = context
+        self.antennaHeight = antennaHeight
+
+    def __getattr__(self, name):
+        return getattr(self.terrain, name)
+
+    def _query(self, kind, f, s, t):
+        key = "%s|%s|%s|%r" % (kind, _formatPoint(s), _formatPoint(t), self.antennaHeight)
+        value = self.cache.get(self.context, key)
+        if value is None:
+            value = bool(f(s, t))
+            self.cache.set(self.context, key, value)
+        return value
+
+    #Batch version of _query : only the pairs missing from the cache are given to f
+    def _queryBatch(self, kind, f, sources, targets):
+        keys = ["%s|%s|%s|%r" % (kind, _formatPoint(s), _formatPoint(t), self.antennaHeight) for s,t in zip(sources, targets)]
+        result = [self.cache.get(self.context, key) for key in keys]
+        missing = [i for i,value in enumerate(result) if value is None]
+        if missing:
+            for i,value in zip(missing, f([sources[i] for i in missing], [targets[i] for i in missing])):
+                result[i] = bool(value)
+                self.cache.set(self.context, keys[i], result[i])
+        return result
+
+    def is_visible(self, s, t):
+        return self._query("v", self.terrain.is_visible, s, t)
+
+    def is_visible_batch(self, sources, targets):
+        return self._queryBatch("v", self.terrain.is_visible_batch, sources, targets)
+
+    def can_communicate_batch(self, sources, targets):
+        return self._queryBatch("c", self.terrain.can_communicate_batch, sources, targets)
+
+    def can_communicate(self, s, t):
+        return self._query("c", self.terrain.can_communicate, s, t)
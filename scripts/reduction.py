@@ -0,0 +1,150 @@
+import itertools
+import logging
+
+import numpy as np
+
+"""
+Reduction of the problem before it is written.
+
+The waypoints of a robot are kept only if they can be reached from the initial position of a
+robot with the same model and waypoint group, and if they are useful : they see an observation
+point, lie on a patrol, are the initial position or can communicate with a reachable waypoint
+of another robot. The points of the communication goals are always kept. Since the distances
+are the costs of the whole path between two points, dropping the other waypoints does not
+lengthen any motion.
+The observation points seen from exactly the same kept waypoints are merged into the first one :
+observing it from any of these waypoints explores all of them.
+"""
+class Reduction:
+    def __init__(self):
+        self.locs = {}           #key:robot. Value : list of the kept waypoints of the robot
+        self.representative = {} #key:observation point. Value : kept observation point it is merged into
+        self.obsList = []        #kept observation points
+        self.obsMask = 0         #bitmask of the ids of the kept observation points
+        self.dropped = []        #(model, wp_group, index) of the waypoints dropped for a model
+        self.merged = []         #observation points merged into another one
+
+    def keepsPatrol(self, robot, patrol):
+        kept = set(self.locs[robot])
+        return all(pt in kept for pt in patrol)
+
+    #Description of the reduction, saved with the problem for the incremental generation
+    def getState(self):
+        return {"waypoints": [list(wp) for wp in self.dropped], "observation_points": self.merged}
+
+#Boolean vector of the points reachable from start through the edges of the boolean matrix valid
+def _reachable(valid, start):
+    reached = np.zeros(len(valid), dtype=bool)
+    reached[start] = True
+    frontier = reached.copy()
+    while frontier.any():
+        frontier = valid[frontier].any(axis=0) & ~reached
+        reached |= frontier
+    return reached
+
+#Points of the communication goals, as (agent, index)
+def _communicationGoalPoints(mission):
+    goals = mission["mission_goal"].get("communication_goals", [])
+    if isinstance(goals, dict):
+        goals = list(goals.values())
+    for c in goals:
+        if "wp_1" in c and "wp_2" in c:
+            yield (c["agent1"], c["wp_1"])
+            yield (c["agent2"], c["wp_2"])
+
+def reduceProblem(p):
+    r = Reduction()
+    robots = p.getRobotList()
+    m = p.missionModel
+
+    #robots sharing a model and a waypoint group keep the same waypoints
+    kind = lambda robot: (p.getRobotModel(robot), m.agents[robot].group)
+    kinds = {}
+    for robot in robots:
+        kinds.setdefault(kind(robot), []).append(robot)
+
+    ### Reachable waypoints ###
+    reachable = {} #key:(model, wp_group). Value : boolean vector over getLocsOfRobot
+    for key,group in kinds.items():
+        locs = p.getLocsOfRobot(group[0])
+        position = dict((wp, i) for i,wp in enumerate(locs))
+        reached = np.zeros(len(locs), dtype=bool)
+        for robot in group:
+            costs = p.computeCostMatrix(robot, p.getCoordsOfLocs(locs))
+            reached |= _reachable(np.isfinite(costs) & (costs != 0), position[p.getInitialPos(robot)])
+        reachable[key] = reached
+
+    ### Useful waypoints ###
+    useful = {}
+    for key,group in kinds.items():
+        model, groupName = key
+        wpGroup = m.groups[groupName]
+        coverage = p.getCoverage(model, groupName)
+        locs = p.getLocsOfRobot(group[0])
+        position = dict((wp, i) for i,wp in enumerate(locs))
+
+        u = np.array([coverage[wpGroup.ids[wp[1]]] != 0 for wp in locs], dtype=bool)
+        for patrol in wpGroup.patrols.values():
+            u[[position[(groupName, i)] for i in patrol]] = True
+        for robot in group:
+            u[position[p.getInitialPos(robot)]] = True
+        useful[key] = u
+
+    #the points of the communication goals are written in the initial plan, so they are always kept
+    required = dict((key, np.zeros(len(u), dtype=bool)) for key,u in useful.items())
+    for agent,index in _communicationGoalPoints(p.mission):
+        key = kind(agent)
+        required[key][p.getLocsOfRobot(agent).index((key[1], index))] = True
+
+    for robot1, robot2 in itertools.combinations(robots, 2):
+        key1, key2 = kind(robot1), kind(robot2)
+        position1 = dict((wp, i) for i,wp in enumerate(p.getLocsOfRobot(robot1)))
+        position2 = dict((wp, i) for i,wp in enumerate(p.getLocsOfRobot(robot2)))
+        for pt1, pt2 in p.getComLinks(robot1, robot2):
+            i, j = position1[pt1], position2[pt2]
+            if reachable[key1][i] and reachable[key2][j]:
+                useful[key1][i] = True
+                useful[key2][j] = True
+
+    ### Kept waypoints ###
+    totalDropped = 0
+    for key,group in sorted(kinds.items()):
+        locs = p.getLocsOfRobot(group[0])
+        kept = (reachable[key] & useful[key]) | required[key]
+        for robot in group:
+            r.locs[robot] = [wp for wp,k in zip(locs, kept) if k]
+        r.dropped.extend((key[0],) + wp for wp,k in zip(locs, kept) if not k)
+        totalDropped += len(locs) - kept.sum()
+
+        logging.info("Reduction of %s on %s : %d/%d waypoints kept, %d unreachable, %d useless" % (key[0], key[1],
+                     kept.sum(), len(locs), (~kept & ~reachable[key]).sum(), (~kept & reachable[key]).sum()))
+        logging.debug("Dropped waypoints of %s : %s" % (key[0], " ".join(p.getLocName(wp) for wp,k in zip(locs, kept) if not k)))
+
+    ### Merged observation points ###
+    observations = m.observations
+    rows = []
+    for (model, groupName),group in kinds.items():
+        wpGroup = m.groups[groupName]
+        ids = [wpGroup.ids[wp[1]] for wp in r.locs[group[0]]]
+        rows.append(p.getVisibilityMatrix(model, groupName)[ids])
+    seenFrom = np.concatenate(rows, axis=0).T if rows else np.zeros((len(observations), 0), dtype=bool)
+
+    first = {} #key:set of waypoints seeing the observation point. Value : first observation point seen from them
+    for j,obs in enumerate(observations.indexes):
+        if not seenFrom[j].any():
+            #not visible : kept as is, it will be reported as an error
+            signature = ("unseen", j)
+        else:
+            signature = np.packbits(seenFrom[j]).tobytes()
+        rep = first.setdefault(signature, obs)
+        r.representative[obs] = rep
+        if rep == obs:
+            r.obsList.append(obs)
+            r.obsMask |= 1 << j
+        else:
+            r.merged.append(obs)
+            logging.debug("Observation point %s is seen from the same waypoints as %s" % (observations.names[j], p.getObsLocName(rep)))
+
+    logging.info("Reduction : %d waypoints dropped, %d/%d observation points merged" % (totalDropped, len(r.merged), len(observations)))
+
+    return r
@@ -0,0 +1,719 @@
+import atexit
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+import querycache
+
+try:
+    import gladys
+except ImportError:
+    gladys = None
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+try:
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra
+except ImportError:
+    dijkstra = None
+
+"""
+Serialize the calls to a terrain model shared between threads
+"""
+class LockedTerrain:
+    def __init__(self, terrain):
+        self.terrain = terrain
+        self.lock = threading.Lock()
+
+    def is_visible(self, s, t):
+        with self.lock:
+            return self.terrain.is_visible(s, t)
+
+    def can_communicate(self, s, t):
+        with self.lock:
+            return self.terrain.can_communicate(s, t)
+
+    def single_source_all_costs(self, s, targets):
+        with self.lock:
+            return self.terrain.single_source_all_costs(s, targets)
+
+    #Build the data used by the cost queries, so that the worker processes started next can share it
+    def prepareCosts(self):
+        with self.lock:
+            if hasattr(self.terrain, "prepareCosts"):
+                self.terrain.prepareCosts()
+
+    #Matrix of the costs from each source to each target, computed row by row if the terrain cannot do it at once
+    def multi_source_all_costs(self, sources, targets):
+        with self.lock:
+            if hasattr(self.terrain, "multi_source_all_costs"):
+                return self.terrain.multi_source_all_costs(sources, targets)
+            return np.array([list(self.terrain.single_source_all_costs(s, targets)) for s in sources], dtype=float).reshape(len(sources), len(targets))
+
+    #Batch versions : sources and targets are sequences of points, the result is a boolean array.
+    #Terrains without batch queries are called pair by pair.
+    def is_visible_batch(self, sources, targets):
+        with self.lock:
+            if hasattr(self.terrain, "is_visible_batch"):
+                return self.terrain.is_visible_batch(sources, targets)
+            return np.array([bool(self.terrain.is_visible(s, t)) for s,t in zip(sources, targets)], dtype=bool)
+
+    def can_communicate_batch(self, sources, targets):
+        with self.lock:
+            if hasattr(self.terrain, "can_communicate_batch"):
+                return self.terrain.can_communicate_batch(sources, targets)
+            return np.array([bool(self.terrain.can_communicate(s, t)) for s,t in zip(sources, targets)], dtype=bool)
+
+#Identity of a file : the same file reached through different paths or links has the same key,
+#and the key changes when the file is modified
+def fileKey(filename):
+    st = os.stat(filename)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+"""
+Read a raster file : a GeoTIFF (requires gdal) or a .npy array.
+Return (data, transform), data being a 2D array for a single band raster and (bands, rows, columns)
+otherwise, and transform the gdal geo transform (x0, dx, rx, y0, ry, dy) of the raster.
+"""
+def readRaster(filename):
+    if filename.endswith(".npy"):
+        return np.load(filename), (0., 1., 0., 0., 0., 1.)
+
+    if gdal is None:
+        raise ImportError("Cannot read %s. Install gdal" % filename)
+    ds = gdal.Open(filename)
+    if ds is None:
+        raise IOError("Cannot open %s" % filename)
+    return ds.ReadAsArray(), tuple(ds.GetGeoTransform())
+
+#Remove the raster stores of parent created by processes that are no longer running
+def _removeStaleStores(parent):
+    for name in os.listdir(parent):
+        fields = name.split("-")
+        if not name.startswith("simato-rasters-") or len(fields) < 4 or not fields[2].isdigit():
+            continue
+        try:
+            os.kill(int(fields[2]), 0)
+        except ProcessLookupError:
+            logging.info("Removing the raster store %s left by a stopped process" % name)
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+        except PermissionError:
+            pass #the process exists, but belongs to another user
+
+"""
+Rasters loaded once in shared memory and read through read-only numpy views.
+
+Each raster is copied into a .npy file of a folder in /dev/shm (or the temporary folder if there is
+no /dev/shm), named after the identity of the source file, and memory-mapped. A store sent to a
+worker process maps the same files, so the rasters are not loaded again and the memory used does
+not grow with the number of workers. The folder is removed at exit by the process that created it,
+and the folders left by processes that were killed are removed when a new one is created.
+The arrays of a source file that has been modified are released with evict().
+"""
+class RasterStore:
+    def __init__(self, folder = None):
+        self.folder = folder
+        self.owner = False
+        self.rasters = {}
+        self.lock = threading.RLock() #derive() loads the raster it depends on
+
+    def __getstate__(self):
+        return {"folder": self.getFolder()}
+
+    def __setstate__(self, state):
+        self.__init__(state["folder"])
+
+    def getFolder(self):
+        with self.lock:
+            if self.folder is None:
+                parent = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+                _removeStaleStores(parent)
+                self.folder = tempfile.mkdtemp(prefix="simato-rasters-%d-" % os.getpid(), dir=parent)
+                self.owner = True
+                atexit.register(self.close)
+            return self.folder
+
+    def _getBase(self, key):
+        return os.path.join(self.getFolder(), hashlib.sha1(repr(key).encode()).hexdigest())
+
+    #Memory-map the arrays stored as key, calling produce() to get (list of arrays, transform) the first time.
+    #source is the identity of the file the arrays are read or computed from
+    def _map(self, key, source, produce):
+        base = self._getBase(key)
+
+        with self.lock:
+            if key not in self.rasters:
+                if not os.path.exists(base + ".json"):
+                    arrays, transform = produce()
+                    tmpSuffix = ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+                    for k,data in enumerate(arrays):
+                        np.save(base + ".%d%s.npy" % (k, tmpSuffix), data)
+                        os.replace(base + ".%d%s.npy" % (k, tmpSuffix), base + ".%d.npy" % k)
+                    #the .json file is renamed last : once it exists, the arrays are complete
+                    with open(base + tmpSuffix + ".json", "w") as f:
+                        json.dump({"key": repr(key), "source": list(source), "transform": transform, "arrays": len(arrays)}, f)
+                    os.replace(base + tmpSuffix + ".json", base + ".json")
+
+                with open(base + ".json") as f:
+                    info = json.load(f)
+                self.rasters[key] = ([np.load(base + ".%d.npy" % k, mmap_mode="r") for k in range(info["arrays"])], tuple(info["transform"]))
+            return self.rasters[key]
+
+    #Return (read-only data, transform) of the raster filename
+    def get(self, filename):
+        def produce():
+            logging.info("Loading the raster %s" % filename)
+            data, transform = readRaster(filename)
+            return [data], transform
+        key = fileKey(filename)
+        arrays, transform = self._map(key, key, produce)
+        return arrays[0], transform
+
+    #Return a read-only array computed once by compute(data) from the raster filename, shared like the rasters
+    def derive(self, filename, name, compute):
+        return self.deriveArrays(filename, name, lambda data: [compute(data)])[0]
+
+    #Return the list of read-only arrays computed once by compute(data) from the raster filename.
+    #params are the other values the arrays depend on
+    def deriveArrays(self, filename, name, compute, params = ()):
+        def produce():
+            data, transform = self.get(filename)
+            logging.info("Computing the %s of %s" % (name, filename))
+            return list(compute(data)), transform
+        key = fileKey(filename)
+        return self._map((name,) + key + tuple(params), key, produce)[0]
+
+    #Release the arrays read or computed from the file of identity source, and remove their files.
+    #The arrays already mapped stay valid until they are no longer used
+    def evict(self, source):
+        with self.lock:
+            folder = self.getFolder()
+            removed = set()
+            for f in os.listdir(folder):
+                if not f.endswith(".json") or f.endswith(".tmp.json"):
+                    continue
+                base = os.path.join(folder, f[:-len(".json")])
+                try:
+                    with open(base + ".json") as info:
+                        info = json.load(info)
+                except (IOError, ValueError):
+                    continue
+                if info["source"] != list(source):
+                    continue
+                os.remove(base + ".json")
+                for k in range(info["arrays"]):
+                    if os.path.exists(base + ".%d.npy" % k):
+                        os.remove(base + ".%d.npy" % k)
+                removed.add(base)
+            self.rasters = dict((k, v) for k,v in self.rasters.items() if self._getBase(k) not in removed)
+
+    def close(self):
+        self.rasters = {}
+        if self.owner:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.owner = False
+
+#Maximum number of costs held at once by the heightfield cost engine (sources x cells)
+costBatchCells = 1 << 24
+
+#Maximum number of ray samples handled at once by the heightfield line of sight
+batchSamples = 1 << 20
+
+#Pieces of rays with fewer samples are checked at full resolution instead of being split
+minPieceSamples = 16
+
+"""
+Multi-resolution bounds of a dtm : level l holds the maximum and the minimum elevation of the
+blocks of 2^l x 2^l cells, level 0 being the dtm. A ray above the maximum of the blocks covering
+a piece of it is clear there, a ray below their minimum is blocked. Unknown (NaN) elevations never
+block a ray : they are ignored by the maximums and prevent the minimums from rejecting.
+The levels above 0 are packed in a single flat array, so that they can be kept in a RasterStore.
+"""
+class ElevationPyramid:
+    def __init__(self, dtm, packed):
+        self.maxLevels = [dtm]
+        self.minLevels = [dtm]
+        offset = 0
+        for shape in ElevationPyramid.getShapes(dtm.shape):
+            size = shape[0] * shape[1]
+            self.maxLevels.append(packed[offset:offset + size].reshape(shape))
+            self.minLevels.append(packed[offset + size:offset + 2 * size].reshape(shape))
+            offset += 2 * size
+
+    #shapes of the levels above 0, up to a single block
+    @staticmethod
+    def getShapes(shape):
+        shapes = []
+        while shape[0] > 1 or shape[1] > 1:
+            shape = ((shape[0] + 1) // 2, (shape[1] + 1) // 2)
+            shapes.append(shape)
+        return shapes
+
+    @staticmethod
+    def build(dtm):
+        result = []
+        upper = lower = np.asarray(dtm, dtype=float)
+        for shape in ElevationPyramid.getShapes(dtm.shape):
+            paddedUpper = np.full((2 * shape[0], 2 * shape[1]), np.nan)
+            paddedUpper[:upper.shape[0], :upper.shape[1]] = upper
+            paddedLower = np.full((2 * shape[0], 2 * shape[1]), np.inf)
+            paddedLower[:lower.shape[0], :lower.shape[1]] = lower
+            upper = np.fmax.reduce(np.fmax.reduce(paddedUpper.reshape(shape[0], 2, shape[1], 2), axis=3), axis=1)
+            lower = np.minimum.reduce(np.minimum.reduce(paddedLower.reshape(shape[0], 2, shape[1], 2), axis=3), axis=1)
+            result += [upper.ravel(), lower.ravel()]
+        return np.concatenate(result) if result else np.zeros(0)
+
+    """
+    Bounds of the elevation over the cells [row0, row1] x [col0, col1] (arrays of inclusive ranges).
+    The level is chosen so that each range spans at most 2 blocks.
+    """
+    def getBounds(self, row0, row1, col0, col1):
+        span = np.maximum(row1 - row0, col1 - col0)
+        level = np.minimum(np.frexp(span.astype(float))[1], len(self.maxLevels) - 1)
+        upper = np.empty(len(span))
+        lower = np.empty(len(span))
+        for l in np.unique(level):
+            k = np.nonzero(level == l)[0]
+            r0, r1, c0, c1 = row0[k] >> l, row1[k] >> l, col0[k] >> l, col1[k] >> l
+            top, bottom = self.maxLevels[l], self.minLevels[l]
+            upper[k] = np.fmax(np.fmax(top[r0, c0], top[r0, c1]), np.fmax(top[r1, c0], top[r1, c1]))
+            lower[k] = np.minimum(np.minimum(bottom[r0, c0], bottom[r0, c1]), np.minimum(bottom[r1, c0], bottom[r1, c1]))
+        return upper, lower
+
+"""
+Sparse graph joining each traversable cell of a mask to its traversable neighbours, weighted by
+their distance. It is built on the first use, and shared by the heightfield terrains using the
+same region and dtm. load returns the arrays of buildArrays() kept in a RasterStore, so that the
+worker processes map the graph instead of building their own.
+"""
+class CostGraph:
+    def __init__(self, mask, transform, load = None):
+        self.mask = mask
+        self.transform = transform
+        self.load = load
+        self.graph = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.graph is None and self.load is None:
+                self.graph = self.build()
+            elif self.graph is None:
+                data, indices, indptr = self.load()
+                self.graph = csr_matrix((data, indices, indptr), shape=(self.mask.size, self.mask.size), copy=False)
+            return self.graph
+
+    #Arrays of the compressed rows of the graph
+    def buildArrays(self):
+        graph = self.build()
+        return [graph.data, graph.indices, graph.indptr]
+
+    def build(self):
+        rows, cols = self.mask.shape
+        dx, dy = abs(self.transform[1]), abs(self.transform[5])
+        free = np.asarray(self.mask > 0)
+        index = np.arange(rows * cols).reshape(rows, cols)
+
+        sources, targets, weights = [], [], []
+        #the graph is undirected : one direction of each move is enough
+        for di, dj in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+            r0, r1 = 0, rows - di
+            c0, c1 = max(0, -dj), cols - max(0, dj)
+            both = free[r0:r1, c0:c1] & free[r0 + di:r1 + di, c0 + dj:c1 + dj]
+            sources.append(index[r0:r1, c0:c1][both])
+            targets.append(index[r0 + di:r1 + di, c0 + dj:c1 + dj][both])
+            weights.append(np.full(both.sum(), math.hypot(di * dy, dj * dx)))
+
+        return csr_matrix((np.concatenate(weights), (np.concatenate(sources), np.concatenate(targets))), shape=(rows * cols, rows * cols))
+
+"""
+Terrain backend working on a heightfield, written with numpy only.
+
+The dtm is a single band raster of the ground elevation. The region raster is used as a
+traversability mask on the same grid : the robot can cross the cells where it is positive (the
+first band is used if it has several). As with gladys, the z of the points given to the queries
+is their height above the ground. The config gives the height and range of the sensor and of
+the antenna of the robot.
+"""
+class HeightfieldTerrain:
+    def __init__(self, dtm, transform, mask, config, pyramid = None, costGraph = None):
+        if mask.ndim == 3:
+            mask = mask[0]
+        if mask.shape != dtm.shape:
+            raise ValueError("The region raster %s and the dtm %s do not have the same size" % (mask.shape, dtm.shape))
+        if transform[2] != 0 or transform[4] != 0:
+            raise ValueError("Rotated rasters are not supported")
+
+        self.dtm = dtm
+        self.pyramid = pyramid if pyramid is not None else ElevationPyramid(dtm, ElevationPyramid.build(dtm))
+        self.mask = mask
+        self.transform = transform
+        self.step = min(abs(transform[1]), abs(transform[5])) #length between two samples of a ray
+
+        self.sensorHeight = config.get("sensor", {}).get("pose", {}).get("z", 0.)
+        self.sensorRange = config.get("sensor", {}).get("range", None)
+        self.antennaHeight = config.get("antenna", {}).get("pose", {}).get("z", 0.)
+        self.antennaRange = config.get("antenna", {}).get("range", None)
+
+        self.costGraph = costGraph if costGraph is not None else CostGraph(mask, transform)
+
+    #(row, column) of the cells containing x, y (scalars or arrays)
+    def getCell(self, x, y):
+        x0, dx, _, y0, _, dy = self.transform
+        return np.floor((np.asarray(y) - y0) / dy).astype(int), np.floor((np.asarray(x) - x0) / dx).astype(int)
+
+    #Cells of x, y (scalars or arrays). Points outside the dtm are moved to the closest border cell
+    def getClippedCell(self, x, y):
+        row, col = self.getCell(x, y)
+        return np.clip(row, 0, self.dtm.shape[0] - 1), np.clip(col, 0, self.dtm.shape[1] - 1)
+
+    #Ground elevation at x, y (scalars or arrays)
+    def getElevation(self, x, y):
+        return self.dtm[self.getClippedCell(x, y)]
+
+    #Absolute positions (n x 3 array) of the points (sequence of (x, y[, z])) lifted by height
+    def getPositions(self, points, height = 0.):
+        points = np.asarray(points, dtype=float).reshape(len(points), -1)
+        z = points[:,2] if points.shape[1] > 2 else 0.
+        return np.column_stack([points[:,0], points[:,1], self.getElevation(points[:,0], points[:,1]) + z + height])
+
+    """
+    Line of sight test of a batch of rays between the absolute positions a and b (n x 3 arrays).
+    Each ray is sampled at the dtm resolution, and is blocked if the ground is above it at one
+    of its samples.
+    The samples are not all read : the pieces of rays are checked against the bounds of the
+    elevation pyramid, and only the pieces that are neither clear nor blocked are split, down
+    to minPieceSamples samples checked one by one. The result is the same as checking every
+    sample, since the samples of a piece lie in the cells between its ends, and the ray height
+    between its heights at the ends.
+    The rays are processed by chunks of at most batchSamples samples, to bound the memory used.
+    """
+    def lineOfSight(self, a, b):
+        a = np.asarray(a, dtype=float).reshape(-1, 3)
+        b = np.asarray(b, dtype=float).reshape(-1, 3)
+        d = b - a
+        n = np.ceil(np.hypot(d[:,0], d[:,1]) / self.step).astype(int) + 1 #number of intervals of each ray
+        result = np.ones(len(a), dtype=bool)
+
+        #the rays are sorted by length, so a chunk is as long as its last ray
+        order = np.argsort(n, kind="stable")
+        start = 0
+        while start < len(order):
+            samples = (n[order[start:]] + 1) * np.arange(1, len(order) - start + 1)
+            rays = order[start:start + max(1, int(np.sum(samples <= batchSamples)))]
+            start += len(rays)
+            result[rays] = self._lineOfSight(a[rays], d[rays], n[rays])
+
+        return result
+
+    #Pyramid descent of lineOfSight over the rays starting at a, of direction d and with n intervals
+    def _lineOfSight(self, a, d, n):
+        result = np.ones(len(a), dtype=bool)
+
+        #sample k of the rays r
+        def sample(r, k):
+            f = np.minimum(k / n[r], 1.)
+            return a[r,0] + f * d[r,0], a[r,1] + f * d[r,1], a[r,2] + f * d[r,2]
+
+        #pieces of rays still to check : samples k0 to k1 of the ray r
+        r = np.arange(len(a))
+        k0 = np.zeros(len(a), dtype=int)
+        k1 = n.copy()
+        while len(r):
+            x0, y0, z0 = sample(r, k0)
+            x1, y1, z1 = sample(r, k1)
+            row0, col0 = self.getClippedCell(x0, y0)
+            row1, col1 = self.getClippedCell(x1, y1)
+            upper, lower = self.pyramid.getBounds(np.minimum(row0, row1), np.maximum(row0, row1), np.minimum(col0, col1), np.maximum(col0, col1))
+
+            result[r[lower > np.maximum(z0, z1)]] = False
+            unsure = (upper > np.minimum(z0, z1)) & result[r]
+
+            short = unsure & (k1 - k0 < minPieceSamples)
+            if short.any():
+                rs, ks = r[short], k0[short]
+                k = ks[:,None] + np.arange(minPieceSamples)[None,:]
+                k = np.minimum(k, k1[short][:,None]) #padding samples repeat the end of the piece
+                x, y, z = sample(rs[:,None], k)
+                blocked = np.any(self.getElevation(x, y) > z, axis=1)
+                result[rs[blocked]] = False
+
+            split = unsure & ~short
+            middle = (k0[split] + k1[split]) // 2
+            r = np.concatenate([r[split], r[split]])
+            k0, k1 = np.concatenate([k0[split], middle]), np.concatenate([middle, k1[split]])
+
+        return result
+
+    def _inRange(self, a, b, maxRange):
+        if maxRange is None:
+            return np.ones(len(a), dtype=bool)
+        return np.sqrt(np.sum((a - b) ** 2, axis=1)) <= maxRange
+
+    def _query(self, sources, targets, height, maxRange):
+        if len(sources) == 0:
+            return np.zeros(0, dtype=bool)
+        a = self.getPositions(sources, height)
+        b = self.getPositions(targets)
+        result = self._inRange(a, b, maxRange)
+        result[result] = self.lineOfSight(a[result], b[result])
+        return result
+
+    def is_visible_batch(self, sources, targets):
+        return self._query(sources, targets, self.sensorHeight, self.sensorRange)
+
+    #targets already include the height of the other antenna
+    def can_communicate_batch(self, sources, targets):
+        return self._query(sources, targets, self.antennaHeight, self.antennaRange)
+
+    def is_visible(self, s, t):
+        return bool(self.is_visible_batch([s], [t])[0])
+
+    def can_communicate(self, s, t):
+        return bool(self.can_communicate_batch([s], [t])[0])
+
+    #Index of the traversable cell of each point in the flattened mask, -1 if there is none
+    def getNodes(self, points):
+        rows, cols = self.mask.shape
+        points = np.asarray(points, dtype=float).reshape(len(points), -1)
+        i, j = self.getCell(points[:,0], points[:,1])
+        inside = (i >= 0) & (i < rows) & (j >= 0) & (j < cols)
+        nodes = np.full(len(points), -1)
+        nodes[inside] = i[inside] * cols + j[inside]
+        nodes[inside] = np.where(self.mask[i[inside], j[inside]] > 0, nodes[inside], -1)
+        return nodes
+
+    def getCostGraph(self):
+        return self.costGraph.get()
+
+    def prepareCosts(self):
+        if dijkstra is not None:
+            self.getCostGraph()
+
+    """
+    Lengths of the shortest paths from each source to each target, moving between the 8 neighbours
+    of the traversable cells. The cost is infinite if a target cannot be reached.
+    All the sources are searched at once on the cost graph, by chunks of costBatchCells costs.
+    """
+    def multi_source_all_costs(self, sources, targets):
+        if dijkstra is None:
+            return np.array([self._single_source_all_costs(s, targets) for s in sources]).reshape(len(sources), len(targets))
+
+        graph = self.getCostGraph()
+        sourceNodes = self.getNodes(sources)
+        targetNodes = self.getNodes(targets)
+        result = np.full((len(sources), len(targets)), np.inf)
+
+        valid = np.nonzero(sourceNodes >= 0)[0]
+        reachable = targetNodes >= 0
+        chunk = max(1, costBatchCells // graph.shape[0])
+        for start in range(0, len(valid), chunk):
+            k = valid[start:start + chunk]
+            costs = dijkstra(graph, directed=False, indices=sourceNodes[k])
+            result[np.ix_(k, np.nonzero(reachable)[0])] = costs[:, targetNodes[reachable]]
+
+        return result
+
+    def single_source_all_costs(self, s, targets):
+        return list(self.multi_source_all_costs([s], targets)[0])
+
+    #Search from a single source, used when scipy is not installed
+    def _single_source_all_costs(self, s, targets):
+        rows, cols = self.mask.shape
+        dx, dy = abs(self.transform[1]), abs(self.transform[5])
+        moves = [(di, dj, math.hypot(di * dy, dj * dx)) for di in [-1, 0, 1] for dj in [-1, 0, 1] if di or dj]
+
+        def cellOf(p):
+            i, j = self.getCell(p[0], p[1])
+            i, j = int(i), int(j)
+            if 0 <= i < rows and 0 <= j < cols and self.mask[i, j] > 0:
+                return (i, j)
+            return None
+
+        start = cellOf(s)
+        goals = set(c for c in (cellOf(t) for t in targets) if c is not None)
+        costs = {}
+        if start is not None:
+            queue = [(0., start)]
+            while queue and goals:
+                c, cell = heapq.heappop(queue)
+                if cell in costs:
+                    continue
+                costs[cell] = c
+                goals.discard(cell)
+                for di, dj, w in moves:
+                    i, j = cell[0] + di, cell[1] + dj
+                    if 0 <= i < rows and 0 <= j < cols and (i, j) not in costs and self.mask[i, j] > 0:
+                        heapq.heappush(queue, (c + w, (i, j)))
+
+        return [costs.get(cellOf(t), float("inf")) for t in targets]
+
+#Changed with the way the viewsheds are computed, so that the saved ones are not reused
+viewshedVersion = 3
+
+"""
+Visibility of a heightfield terrain read from viewsheds.
+
+For each observation point and each height of the sensor above the ground, the cells from which
+the point is visible are computed once, by casting rays from the centers of all the cells within
+the sensor range. The viewsheds are saved in folder, named after the dtm content and their
+parameters, so that missions on the same map reuse them. A visibility query is then a lookup of
+the cell of the sensor, the sensor range being checked with the exact positions.
+"""
+class ViewshedTerrain:
+    def __init__(self, terrain, folder, dtmFile):
+        self.terrain = terrain
+        self.heightfield = terrain.terrain if isinstance(terrain, LockedTerrain) else terrain
+        if not isinstance(self.heightfield, HeightfieldTerrain):
+            raise ValueError("Viewsheds require the heightfield backend")
+        self.folder = folder
+        self.dtmDigest = querycache.fileDigest(dtmFile)
+        self.viewsheds = {} #key:(target, height). Value : (first row, first column, visibility window)
+
+    def __getattr__(self, name):
+        return getattr(self.terrain, name)
+
+    def computeViewshed(self, target, height):
+        hf = self.heightfield
+        rows, cols = hf.dtm.shape
+        row0, col0, row1, col1 = 0, 0, rows - 1, cols - 1
+        if hf.sensorRange is not None:
+            corners = [hf.getClippedCell(target[0] + sx * hf.sensorRange, target[1] + sy * hf.sensorRange) for sx in [-1, 1] for sy in [-1, 1]]
+            row0, row1 = min(int(c[0]) for c in corners), max(int(c[0]) for c in corners)
+            col0, col1 = min(int(c[1]) for c in corners), max(int(c[1]) for c in corners)
+
+        #lineOfSight processes the rays by chunks, so the memory does not grow with the ray lengths
+        i, j = np.mgrid[row0:row1 + 1, col0:col1 + 1]
+        x0, dx, _, y0, _, dy = hf.transform
+        x = (x0 + (j + 0.5) * dx).ravel()
+        y = (y0 + (i + 0.5) * dy).ravel()
+        a = np.column_stack([x, y, hf.dtm[i, j].ravel() + height])
+        b = np.repeat(hf.getPositions([target]), len(a), axis=0)
+        return row0, col0, hf.lineOfSight(a, b).reshape(i.shape)
+
+    def getViewshed(self, target, height):
+        key = (tuple(float(c) for c in target), float(height))
+        if key not in self.viewsheds:
+            hf = self.heightfield
+            name = hashlib.sha1(repr((viewshedVersion, self.dtmDigest, tuple(hf.transform), hf.sensorRange) + key).encode()).hexdigest()
+            filename = os.path.join(self.folder, name + ".npz")
+            if os.access(filename, os.R_OK):
+                with np.load(filename) as data:
+                    self.viewsheds[key] = (int(data["origin"][0]), int(data["origin"][1]), data["visible"])
+            else:
+                logging.info("Computing the viewshed of %s at %s m" % (key[0], key[1]))
+                row0, col0, visible = self.computeViewshed(target, height)
+                os.makedirs(self.folder, exist_ok=True)
+                tmpFile = os.path.join(self.folder, name + ".%d.%d.tmp.npz" % (os.getpid(), threading.get_ident()))
+                np.savez_compressed(tmpFile, origin=np.array([row0, col0]), visible=visible)
+                os.replace(tmpFile, filename)
+                self.viewsheds[key] = (row0, col0, visible)
+        return self.viewsheds[key]
+
+    def is_visible_batch(self, sources, targets):
+        hf = self.heightfield
+        result = np.zeros(len(sources), dtype=bool)
+        if len(sources) == 0:
+            return result
+
+        points = np.asarray(sources, dtype=float).reshape(len(sources), -1)
+        heights = (points[:,2] if points.shape[1] > 2 else np.zeros(len(points))) + hf.sensorHeight
+        rows, cols = hf.getClippedCell(points[:,0], points[:,1])
+        inRange = hf._inRange(hf.getPositions(sources, hf.sensorHeight), hf.getPositions(targets), hf.sensorRange)
+
+        groups = {}
+        for k,t in enumerate(targets):
+            groups.setdefault((tuple(t), heights[k]), []).append(k)
+
+        for (target, height),k in groups.items():
+            row0, col0, visible = self.getViewshed(target, height)
+            k = np.array(k)
+            i, j = rows[k] - row0, cols[k] - col0
+            inside = (i >= 0) & (i < visible.shape[0]) & (j >= 0) & (j < visible.shape[1])
+            result[k[inside]] = visible[i[inside], j[inside]]
+
+        return result & inRange
+
+    def is_visible(self, s, t):
+        return bool(self.is_visible_batch([s], [t])[0])
+
+#gladys reads the config with the rasters : nothing can be shared between configs
+def loadGladys(regionFile, dtmFile, configFile, rasters, shared):
+    if gladys is None:
+        raise ImportError("Cannot use the gladys backend. Install gladys [and setup PYTHONPATH]")
+    return gladys.gladys(regionFile, dtmFile, configFile)
+
+def loadHeightfield(regionFile, dtmFile, configFile, rasters, shared):
+    dtm, transform = rasters.get(dtmFile)
+    mask, _ = rasters.get(regionFile)
+    if mask.ndim == 3:
+        mask = mask[0]
+    pyramid = ElevationPyramid(dtm, rasters.derive(dtmFile, "elevation pyramid", ElevationPyramid.build))
+    if "costGraph" not in shared:
+        build = lambda region: CostGraph(mask, transform).buildArrays()
+        shared["costGraph"] = CostGraph(mask, transform, lambda: rasters.deriveArrays(regionFile, "cost graph", build, transform))
+    with open(configFile) as f:
+        config = json.load(f)
+    return HeightfieldTerrain(dtm, transform, mask, config, pyramid, shared["costGraph"])
+
+#key:backend name. Value : function loading a terrain from (regionFile, dtmFile, configFile, rasters, shared),
+#shared being a dictionary where the objects that do not depend on the config are kept for the other terrains
+#using the same region and dtm
+#A terrain provides is_visible(s, t), can_communicate(s, t) and single_source_all_costs(s, targets)
+backends = {"gladys": loadGladys, "heightfield": loadHeightfield}
+defaultBackend = "gladys" if gladys is not None else "heightfield"
+
+"""
+Keeps the terrain models loaded, so that they can be shared by several models and generations.
+Terrains are keyed by their backend and the identity of their files : models using the same region, dtm and
+config files share one instance, and a terrain is reloaded if one of its files has been modified.
+The data that does not depend on the config is shared by the terrains using the same region and dtm : the
+rasters are kept in a RasterStore, which can be shared with worker processes, and the other objects in a
+dictionary per backend, region and dtm given to the backend.
+When a file has been modified, the terrains and the data loaded from its previous version are released.
+"""
+class TerrainPool:
+    def __init__(self, rasters = None):
+        self.terrains = {}
+        self.shared = {} #key:(backend, region, dtm). Value : dictionary of the objects shared by their terrains
+        self.fileKeys = {} #key:real path of a file used by a terrain. Value : identity of the file when it was loaded
+        self.rasters = rasters if rasters is not None else RasterStore()
+        self.lock = threading.Lock()
+
+    def get(self, regionFile, dtmFile, configFile, backend = defaultBackend):
+        files = (regionFile, dtmFile, configFile)
+        key = (backend,) + tuple(fileKey(f) for f in files)
+
+        with self.lock:
+            for f,k in zip(files, key[1:]):
+                path = os.path.realpath(f)
+                if self.fileKeys.get(path, k) != k:
+                    logging.info("%s has been modified. Releasing its previous version" % f)
+                    self.evict(self.fileKeys[path])
+                self.fileKeys[path] = k
+
+            if key not in self.terrains:
+                logging.info("Loading the terrain %s %s %s with %s" % (files + (backend,)))
+                shared = self.shared.setdefault(key[:3], {})
+                self.terrains[key] = LockedTerrain(backends[backend](regionFile, dtmFile, configFile, self.rasters, shared))
+            else:
+                logging.debug("Reusing the terrain %s %s %s with %s" % (files + (backend,)))
+            return self.terrains[key]
+
+    #Release the terrains, shared objects and rasters depending on the file of identity source
+    def evict(self, source):
+        self.terrains = dict((k, v) for k,v in self.terrains.items() if source not in k[1:])
+        self.shared = dict((k, v) for k,v in self.shared.items() if source not in k[1:])
+        self.rasters.evict(source)